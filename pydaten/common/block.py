@@ -20,6 +20,7 @@ class Block(object):
         self.transactions = transactions
         self.nonce = nonce
         self.update_merkle_root()
+        self._hash = None # (header, PoW hash), recomputed when the header changes
 
     def update_merkle_root(self):
         self.merkle_root = self.calculate_merkle_root() if self.transactions else None
@@ -90,10 +91,17 @@ class Block(object):
 
     def calculate_hash(self):
         header = self.serialize(header_only = True)
-        return config.POW_HASH_FUNCTION(header)
+        if self._hash is None or self._hash[0] != header:
+            self._hash = (header, config.POW_HASH_FUNCTION(header))
+        return self._hash[1]
+
+    def remember_hash(self, block_hash):
+        # A hash computed elsewhere for the current header.
+        self._hash = (self.serialize(header_only = True), block_hash)
 
     def __eq__(self, other):
-        return self.calculate_hash() == other.calculate_hash()
+        # Same header, same hash.
+        return self.serialize(header_only = True) == other.serialize(header_only = True)
 
 if __name__ == '__main__':
     pass
@@ -10,6 +10,15 @@ from pydaten.common.address import Address, NameAddress
 from pydaten.common.errors import *
 
 class Transaction:
+    # Encoded bytes and the hash are kept once computed. Setting a field drops them,
+    # fields are not expected to be changed in place.
+
+    def __setattr__(self, name, value):
+        self.__dict__['_serialized'] = None
+        self.__dict__['_hash'] = None
+        if name != 'signature':
+            self.__dict__['_signable'] = None
+        self.__dict__[name] = value
 
     def __init__(self, version, target, fee, name, source, destination, amount, data, signature):
         self.version = version
@@ -23,6 +32,19 @@ class Transaction:
         self.signature = signature
 
     def serialize(self, signature_included = True):
+        if signature_included and self._serialized is not None:
+            return self._serialized
+        signable = self.signable()
+        if not signature_included:
+            return signable
+        stream = ByteStream()
+        stream.write(signable)
+        stream.write_uint8(len(self.signature))
+        stream.write(self.signature)
+        self.__dict__['_serialized'] = stream.value()
+        return self._serialized
+
+    def _encode(self):
         stream = ByteStream()
         stream.write_uint8(self.version)
         stream.write_uint32(self.target)
@@ -39,10 +61,6 @@ class Transaction:
 
         self.data.write(stream)
 
-        if signature_included:
-            stream.write_uint8(len(self.signature))
-            stream.write(self.signature)
-
         return stream.value()
 
     def deserialize(serialized, signature_included = True):
@@ -64,6 +82,8 @@ class Transaction:
 
             signature = raw.read(raw.read_uint8()) if signature_included else None
 
+            # The given bytes are not kept, an encoding that is not canonical would be
+            # hashed and verified differently than the transaction it decodes to.
             return Transaction(version, target, fee, name, source, destination, amount, data, signature)
         except:
             raise TransactionCorrupted()
@@ -72,10 +92,14 @@ class Transaction:
         return self.destination.push(self.name)
 
     def calculate_hash(self):
-        return config.REGULAR_HASH_FUNCTION(self.serialize())
+        if self._hash is None:
+            self.__dict__['_hash'] = config.REGULAR_HASH_FUNCTION(self.serialize())
+        return self._hash
 
     def signable(self):
-        return self.serialize(signature_included = False)
+        if self._signable is None:
+            self.__dict__['_signable'] = self._encode()
+        return self._signable
 
     def valid(self):
         result = NameAddress.valid_part(self.name)
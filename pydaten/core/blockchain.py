@@ -6,32 +6,78 @@ import time
 import os
 from abc import ABC, abstractmethod
 
-from pydaten.common.transaction import Transaction
-from pydaten.common.block import Block
 from pydaten.utils import misc
-from pydaten.utils.bytestream import ByteStream
+from pydaten.utils.lru import LRUCache
 from pydaten.core import difficulty
 from pydaten.defaults import config, genesis
-from pydaten.common.data import NoData
 from pydaten.common.address import *
 from pydaten.core.errors import *
-from pydaten.crypto import ecdsa
 from pydaten.core.world import World
+from pydaten.core.verification import SignatureBatch, verify_signature
+from pydaten.core.template import BlockTemplate
 
 class Blockchain(object):
 
-    def __init__(self, path):
-        self.world = World(path)
-        self.transactions = []
+    def __init__(self, storage, prune_depth = None, codec = config.STORAGE_CODEC, instrument = config.STORAGE_STATS):
+        self.world = storage if isinstance(storage, World) else World(storage, prune_depth, codec, instrument)
         self.lock = threading.RLock()
+        self.clear_transactions()
+        # Transactions relayed to us are not verified again when they come in a block.
+        self.signature_cache = LRUCache(config.SIGNATURE_CACHE_SIZE)
         if self.get_height() == 0:
             self.push_block(genesis.genesis_block())
 
+    def view(self):
+        # Reads from one consistent state, for request handlers running next to block writers.
+        return BlockchainView(self.world.view())
+
+    def close(self):
+        self.world.close()
+
     def get_block(self, index):
         return self.world.get_block(index)
 
     def get_block_range(self, start, end):
-        return [self.get_block(i) for i in range(start, end)]
+        return self.world.get_block_range(start, end)
+
+    def get_header(self, index):
+        return self.world.get_header(index)
+
+    def get_header_range(self, start, end):
+        return self.world.get_header_range(start, end)
+
+    def get_block_hash(self, index):
+        return self.world.get_block_hash(index)
+
+    def get_height_by_hash(self, block_hash):
+        return self.world.get_height_by_hash(block_hash)
+
+    def get_block_by_hash(self, block_hash):
+        index = self.get_height_by_hash(block_hash)
+        return self.get_block(index) if index is not None else None
+
+    def get_locator(self):
+        # Hashes from the tip down to the lowest header we have, the genesis block unless imported
+        # from a snapshot. One per block first, then with a doubling step.
+        locator = []
+        lowest = self.world.get_header_start()
+        index = self.get_height() - 1
+        step = 1
+        while index > lowest:
+            locator.append(self.get_block_hash(index))
+            if len(locator) >= config.LOCATOR_DENSE_HASHES:
+                step *= 2
+            index -= step
+        locator.append(self.get_block_hash(lowest))
+        return locator
+
+    def find_fork(self, locator):
+        # Height of the first block of a peer's locator that is also ours.
+        for block_hash in locator:
+            index = self.get_height_by_hash(block_hash)
+            if index is not None:
+                return index
+        return None
 
     def get_blocks(self):
         return self.get_block_range(0, self.get_height())
@@ -39,6 +85,9 @@ class Blockchain(object):
     def get_latest_block(self):
         return self.world.get_latest_block()
 
+    def get_latest_header(self):
+        return self.world.get_latest_header()
+
     def get_height(self):
         return self.world.get_height()
 
@@ -48,27 +97,52 @@ class Blockchain(object):
         except:
             return None
 
+    def resolve_many(self, addresses):
+        return self.world.resolve_many(addresses)
+
     def get_balance(self, raw_address):
         return self.world.get_balance(raw_address)
 
     def pop_block(self):
         with self.lock:
             popped = self.world.pop_block()
-            self.transactions = []
+            self.clear_transactions()
             return popped
 
     def push_block(self, block):
         with self.lock:
             self.is_next_block(block)
             self.world.push_block(block)
-            self.transactions = []
+            self.clear_transactions()
+
+    def import_blocks(self, blocks, flush_blocks = config.IMPORT_FLUSH_BLOCKS, flush_bytes = config.IMPORT_FLUSH_BYTES):
+        with self.lock:
+            imported = 0
+            self.world.begin_import()
+            try:
+                for block in blocks:
+                    try:
+                        self.is_next_block(block)
+                    except BlockchainException:
+                        # Keep the blocks validated so far.
+                        self.world.flush_import()
+                        raise
+                    self.world.push_block(block)
+                    imported += 1
+                    if imported % flush_blocks == 0 or self.world.import_size() >= flush_bytes:
+                        self.world.flush_import()
+                self.world.flush_import()
+            finally:
+                self.world.end_import()
+                self.clear_transactions()
+            return imported
 
     def calculate_hash_difficulty(self):
-        block = self.get_latest_block()
-        current_difficulty = difficulty.decompress(block.difficulty)
-        if block.index > 0 and block.index % config.DIFFICULTY_ADJUSTMENT_SPAN == 0:
-            block_delta = self.get_block(block.index - config.DIFFICULTY_ADJUSTMENT_SPAN)
-            timestamp_delta = (block.timestamp - block_delta.timestamp) // config.DIFFICULTY_ADJUSTMENT_SPAN
+        index = self.get_height() - 1
+        current_difficulty = difficulty.decompress(self.world.get_difficulty(index))
+        if index > 0 and index % config.DIFFICULTY_ADJUSTMENT_SPAN == 0:
+            timestamp_delta = (self.world.get_timestamp(index) -
+                               self.world.get_timestamp(index - config.DIFFICULTY_ADJUSTMENT_SPAN)) // config.DIFFICULTY_ADJUSTMENT_SPAN
             numerator, denominator = (timestamp_delta, config.TARGET_TIME_PER_BLOCK)
             if denominator > config.DIFFICULTY_CHANGE_RATIO_LIMIT * numerator:
                 numerator, denominator = (1, config.DIFFICULTY_CHANGE_RATIO_LIMIT)
@@ -88,7 +162,7 @@ class Blockchain(object):
 
     def is_next_block(self, block):
         # Check genesis block
-        if self.get_height() == 0 and block == genesis.genesis_block():
+        if self.get_height() == 0 and block.index == 0 and block.calculate_hash() == genesis.GENESIS_HASH:
             return
 
         # Check if it is a valid block
@@ -99,13 +173,12 @@ class Blockchain(object):
             raise InvalidIndex()
 
         # Check if it points to the previous block
-        if block.previous_hash != self.get_latest_block().calculate_hash():
+        if block.previous_hash != self.get_block_hash(block.index - 1):
             raise InvalidPreviousHash()
 
         # Check if timestamp is logical
         if block.index >= config.BLOCKS_CLOCK_CHECK:
-            previous_blocks = self.get_block_range(block.index - config.BLOCKS_CLOCK_CHECK, block.index)
-            timestamps = [b.timestamp for b in previous_blocks]
+            timestamps = self.world.get_timestamps(block.index - config.BLOCKS_CLOCK_CHECK, block.index)
             med = misc.median(timestamps)
             if block.timestamp <= med:
                 raise InvalidTimestamp()
@@ -115,65 +188,80 @@ class Blockchain(object):
         if claimed_difficulty != self.calculate_hash_difficulty():
             raise InvalidDifficulty()
 
-        # Check if all transactions are valid
-        payers = dict()
-        hashes = set()
-        fees = 0
-        for transaction in block.transactions[:-2]:
-
-            # Check if the transaction has minimum validity in this blockchain.
-            self.is_valid_transaction(transaction)
+        # Resolve every address of the block in one pass
+        resolved = self.resolve_many(Blockchain.transaction_addresses(block.transactions))
 
-            # Check if transaction is targeting this block
-            if transaction.target != block.index:
-                raise InvalidTransactionTarget()
-
-            # Check if it is not a duplicate transaction
-            transaction_hash = transaction.calculate_hash()
-            if transaction_hash not in hashes:
-                hashes.add(transaction_hash)
-            else:
-                raise DuplicatedTransactionsFound()
-
-            source = self.resolve(transaction.source)
-            destination = self.resolve(transaction.destination)
-            if source not in payers:
-                payers[source] = 0
-            if destination not in payers:
-                payers[destination] = 0
-            payers[source] += transaction.amount + transaction.fee
-            payers[destination] -= transaction.amount
-
-            fees += transaction.fee
-
-        # Check if payers have enough balance
-        for payer in payers:
-            balance = self.get_balance(payer)
-            if payers[payer] > balance:
-                raise BalanceNotEnough()
+        # Signatures are verified in the background while the checks below run in order
+        transactions = block.transactions[:-2]
+        transaction_hashes = [tx.calculate_hash() for tx in transactions]
+        signatures = SignatureBatch([(tx, resolved[tx.source], transaction_hash)
+                                     for tx, transaction_hash in zip(transactions, transaction_hashes)
+                                     if resolved[tx.source] is not None], self.signature_cache)
+        try:
+            # Check if all transactions are valid
+            payers = dict()
+            hashes = set()
+            fees = 0
+            for transaction, transaction_hash in zip(transactions, transaction_hashes):
+
+                # Check if the transaction has minimum validity in this blockchain.
+                self.check_transaction(transaction)
+                self.check_transaction_state(transaction, resolved)
+
+                # Check if transaction is targeting this block
+                if transaction.target != block.index:
+                    raise InvalidTransactionTarget()
+
+                # Check if it is not a duplicate transaction
+                if transaction_hash not in hashes:
+                    hashes.add(transaction_hash)
+                else:
+                    raise DuplicatedTransactionsFound()
+
+                source = resolved[transaction.source]
+                destination = resolved[transaction.destination]
+                if source not in payers:
+                    payers[source] = 0
+                if destination not in payers:
+                    payers[destination] = 0
+                payers[source] += transaction.amount + transaction.fee
+                payers[destination] -= transaction.amount
+
+                fees += transaction.fee
+
+            # Check if payers have enough balance
+            for payer in payers:
+                balance = self.get_balance(payer)
+                if payers[payer] > balance:
+                    raise BalanceNotEnough()
+
+            # Check if they are signed by their sources
+            if not signatures.wait():
+                raise InvalidTransactionSignature()
+        finally:
+            signatures.cancel()
 
         # Check fee transaction
         fee_transaction = block.transactions[-2]
-        if not fee_transaction.valid() or fee_transaction.source != config.NOWHERE_NAME or fee_transaction.amount != fees or self.resolve(fee_transaction.destination) is None:
+        if not fee_transaction.valid() or fee_transaction.source != config.NOWHERE_NAME or fee_transaction.amount != fees or resolved[fee_transaction.destination] is None:
             raise InvalidFeeTransaction()
 
         # Check reward transaction
         reward_transaction = block.transactions[-1]
-        if not reward_transaction.valid() or reward_transaction.source != config.SUPPLY_NAME or reward_transaction.amount != self.calculate_reward() or self.resolve(reward_transaction.destination) is None:
+        if not reward_transaction.valid() or reward_transaction.source != config.SUPPLY_NAME or reward_transaction.amount != self.calculate_reward() or resolved[reward_transaction.destination] is None:
             raise InvalidRewardTransaction()
 
-    def is_valid_block(self, block):
-        # Check block size
-        if len(block.serialize()) > config.MAX_BLOCK_SIZE:
-            raise BlockTooLarge()
+    def check_block(block):
+        # Checks that do not depend on the chain, only the PoW of a header without its transactions.
 
-        # Check block validity.
-        if not block.valid():
-            raise InvalidBlock()
+        if block.transactions is not None:
+            # Check block size
+            if len(block.serialize()) > config.MAX_BLOCK_SIZE:
+                raise BlockTooLarge()
 
-        # Check if it isn't an old block
-        if block.index < self.get_height():
-            raise BlockOld()
+            # Check block validity.
+            if not block.valid():
+                raise InvalidBlock()
 
         # Check if minimum PoW has been done on it
         block_hash = block.calculate_hash()
@@ -183,30 +271,63 @@ class Blockchain(object):
             not difficulty.less_or_equal(claimed_difficulty, config.MINIMUM_HASH_DIFFICULTY):
             raise InvalidDifficulty()
 
+    def check_block_state(self, block):
+        # Check if it isn't an old block
+        if block.index < self.get_height():
+            raise BlockOld()
+
+    def is_valid_block(self, block):
+        Blockchain.check_block(block)
+        self.check_block_state(block)
         return True
 
     def fork(self, blocks):
+        # The branch is tried on an overlay, only a longer one is committed, in one batch.
         with self.lock:
-            prev_height = self.get_height()
-            fork_height = blocks[0].index - 1
-            popped = []
-            while self.get_height() - 1 != fork_height:
-                popped.append(self.pop_block())
+            branch = self.branch(blocks[0].index - 1)
             for b in blocks:
                 try:
-                    self.push_block(b)
+                    branch.push_block(b)
                 except:
                     break
-            if self.get_height() > prev_height:
+            return self.merge(branch)
+
+    def branch(self, fork_height):
+        # A blockchain on an overlay of ours, down to 'fork_height'. Blocks pushed to it stay
+        # in memory until it is merged.
+        with self.lock:
+            if fork_height + 1 < self.world.get_pruned_height():
+                raise ForkTooDeep()
+            branch = Blockchain(self.world.overlay())
+            branch.signature_cache = self.signature_cache
+            while branch.get_height() - 1 != fork_height:
+                branch.pop_block()
+            return branch
+
+    def merge(self, branch):
+        # Replaces our blocks with the ones of a branch when it is longer. A branch taken
+        # before our last commit reads a state that is gone, it is not merged.
+        with self.lock:
+            if branch.world.generation_below != self.world.generation:
+                return False
+            if branch.get_height() > self.get_height():
+                self.world.merge(branch.world)
+                self.clear_transactions()
                 return True
             else:
-                while self.get_height() - 1 != fork_height:
-                    self.pop_block()
-                while popped:
-                    self.push_block(popped.pop())
                 return False
 
-    def is_valid_transaction(self, transaction):
+    def transaction_addresses(transactions):
+        addresses = []
+        for transaction in transactions:
+            addresses.extend([transaction.source, transaction.destination])
+            if transaction.name:
+                addresses.append(transaction.address())
+        return addresses
+
+    def check_transaction(self, transaction):
+        # Checks that do not depend on the chain
+
         # Check if transaction structure is valid
         if not transaction.valid():
             raise InvalidTransaction()
@@ -215,133 +336,120 @@ class Blockchain(object):
         if transaction.version > config.VERSION:
             raise NotSupportedTransaction()
 
+    def check_transaction_state(self, transaction, resolved):
+        # Checks against the chain, except the signature. Addresses come resolved.
+
         # Check if it is in the next blocks
         if transaction.target < self.get_height():
             raise InvalidTransactionTarget()
 
         # Check if name has not taken yet
         if transaction.name:
-            if self.resolve(transaction.address()):
+            if resolved[transaction.address()]:
                 raise NameTaken()
 
-        # Check if it is signed by the source
-        source = self.resolve(transaction.source)
-        if source is None:
+        if resolved[transaction.source] is None:
             raise InvalidTransactionSource()
-        if not ecdsa.verify(transaction.signable(), source.public_key, transaction.signature):
-            raise InvalidTransactionSignature()
-        destination = self.resolve(transaction.destination)
-        if destination is None:
+        if resolved[transaction.destination] is None:
             raise InvalidTransactionDestination()
 
+    def is_valid_transaction(self, transaction):
+        self.validate_transaction(transaction)
         return True
 
-    def add_transaction(self, transaction):
+    def validate_transaction(self, transaction, transaction_hash = None):
+        # Returns the resolved addresses of a valid transaction.
+        self.check_transaction(transaction)
+        resolved = self.resolve_many(Blockchain.transaction_addresses([transaction]))
+        self.check_transaction_state(transaction, resolved)
 
-        # Check if it is a valid transaction
-        self.is_valid_transaction(transaction)
+        # Check if it is signed by the source
+        if not verify_signature(transaction, resolved[transaction.source], self.signature_cache, transaction_hash):
+            raise InvalidTransactionSignature()
 
-        # Check if it is in the next block
-        if transaction.target != self.get_height():
-            raise InvalidTransactionTarget()
+        return resolved
 
-        # Check if it is not a duplicate transaction
-        transaction_hash = transaction.calculate_hash()
-        for tx in self.transactions:
-            if transaction_hash == tx.calculate_hash():
-                raise DuplicatedTransactionsFound()
+    def clear_transactions(self):
+        # Pending transactions, with their hashes, the names they register and the
+        # net amount each account pays in them.
+        self.transactions = []
+        self.transaction_hashes = set()
+        self.reserved_names = set()
+        self.spent = {}
+        self.template = None # Built by new_block, later transactions are added to it
 
-        source = self.resolve(transaction.source)
+    def add_transaction(self, transaction):
+        with self.lock:
 
-        # Check if payers have enough balance
-        spent = 0
-        for tx in self.transactions:
-            tx_source = self.resolve(tx.source)
-            tx_destination = self.resolve(tx.destination)
-            if tx_source == source:
-                spent += tx.amount + tx.fee
-            if tx_destination == source:
-                spent -= tx.amount
+            # Check if it is in the next block
+            if transaction.target != self.get_height():
+                raise InvalidTransactionTarget()
 
-        spent += transaction.amount + transaction.fee
+            # Check if it is not a duplicate transaction
+            transaction_hash = transaction.calculate_hash()
+            if transaction_hash in self.transaction_hashes:
+                raise DuplicatedTransactionsFound()
 
-        balance = self.get_balance(source)
-        if spent > balance:
-            raise BalanceNotEnough()
+            # Check if it is a valid transaction
+            resolved = self.validate_transaction(transaction, transaction_hash)
 
-        self.transactions.append(transaction)
+            # Check if no pending transaction registers the same name
+            name = transaction.address() if transaction.name else None
+            if name in self.reserved_names:
+                raise NameTaken()
 
-    def latest(self, address):
-        latest_block = self.get_latest_block()
+            # Check if payers have enough balance
+            source = resolved[transaction.source]
+            destination = resolved[transaction.destination]
+            spent = self.spent.get(source, 0) + transaction.amount + transaction.fee
+            if spent > self.get_balance(source):
+                raise BalanceNotEnough()
+
+            self.transactions.append(transaction)
+            self.transaction_hashes.add(transaction_hash)
+            if name is not None:
+                self.reserved_names.add(name)
+            self.spent[source] = spent
+            self.spent[destination] = self.spent.get(destination, 0) - transaction.amount
+            if self.template is not None:
+                self.template.add(transaction)
+
+    def latest(self, address, before = None, limit = config.QUERY_MAX_TRANSACTIONS):
         address = self.resolve(address)
-        history = []
-        start = max(latest_block.index - config.QUERY_MAX_BLOCKS, 0)
-        end = latest_block.index + 1
-        for i in range(start, end):
-            block = self.get_block(i)
-            for tx in block.transactions:
-                src = self.resolve(tx.source)
-                dst = self.resolve(tx.destination)
-                if src == address or dst == address:
-                    history.append(tx)
-        return history
+        if address is None:
+            return []
+        return self.world.history(address, before, min(limit, config.QUERY_MAX_TRANSACTIONS))
 
     def find(self, name):
         return self.world.find(name)
 
-    def find_children(self, name):
-        return self.world.find_children(name)
-
-    def new_block(self, miner, timestamp):
-
-        fees = 0
-        for tx in self.transactions:
-            fees += tx.fee
-
-        reward = self.calculate_reward()
-
-        latest_block = self.get_latest_block()
-        index = latest_block.index + 1
-        previous_hash = latest_block.calculate_hash()
-        transactions = list(self.transactions)
+    def find_children(self, name, after = None, limit = config.QUERY_MAX_CHILDREN):
+        return self.world.find_children(name, after, limit)
 
-        # Sort by byte-price.
-        transactions.sort(key = lambda t: t.fee / len(t.serialize()))
+    def iter_children(self, name, after = None, limit = config.QUERY_MAX_CHILDREN):
+        return self.world.iter_children(name, after, limit)
 
-        fee_transaction = Transaction(
-            version = config.VERSION, target = index, fee = 0,
-            name = misc.random_name(),
-            source = config.NOWHERE_NAME,
-            destination = miner,
-            amount = fees,
-            data = NoData(),
-            signature = b'')
-        transactions.append(fee_transaction)
+    def count_children(self, name):
+        return self.world.count_children(name)
 
-        reward_transaction = Transaction(
-            version = config.VERSION, target = index, fee = 0,
-            name = misc.random_name(),
-            source = config.SUPPLY_NAME,
-            destination = miner,
-            amount = reward,
-            data = NoData(),
-            signature = b'')
-        transactions.append(reward_transaction)
-
-        diff = self.calculate_hash_difficulty()
-        compressed_diff = difficulty.compress(diff)
-
-        next_block = Block(index, timestamp, previous_hash, compressed_diff, transactions, 0)
-
-        while len(next_block.serialize()) > config.MAX_BLOCK_SIZE:
-            tx = next_block.transactions.pop(0)
-            fee_transaction.amount -= tx.fee
-        next_block.update_merkle_root()
-
-        return next_block
+    def new_block(self, miner, timestamp):
+        with self.lock:
+            index = self.get_height()
+            compressed_diff = difficulty.compress(self.calculate_hash_difficulty())
+            self.template = BlockTemplate(index, timestamp, self.get_block_hash(index - 1), compressed_diff,
+                                          miner, self.calculate_reward())
+            self.template.add_all(self.transactions)
+            return self.template.get_block()
 
     def mine_block(block):
         diff = difficulty.decompress(block.difficulty)
         block.nonce = 0
         while not difficulty.less_or_equal(block.calculate_hash(), diff):
             block.nonce += 1
+
+class BlockchainView(Blockchain):
+    # The read side of a blockchain, without the pool of transactions or the signature cache.
+    # Taken for every request, it should be closed once the request is answered.
+
+    def __init__(self, world):
+        self.world = world
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from pydaten.common.block import Block
+from pydaten.core.blockchain import Blockchain
+from pydaten.core.errors import BlockchainException, VerificationBusy
+from pydaten.defaults import config
+
+# Blockchain.check_block runs in worker processes, Argon2 and merkle roots keep
+# neither the event loop nor the GIL busy.
+_executor = None
+_executor_lock = threading.Lock()
+_pending = 0 # Tasks submitted by check_blocks_async and not done yet
+_pending_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers = config.BLOCK_CHECK_WORKERS)
+        return _executor
+
+def _check_chunk(chunk):
+    # In a worker process. Errors are returned as their class, they are not pickled.
+    results = []
+    for raw, header_only in chunk:
+        block = Block.deserialize(raw, header_only = header_only)
+        try:
+            Blockchain.check_block(block)
+            results.append((block.calculate_hash(), None))
+        except BlockchainException as e:
+            results.append((None, type(e)))
+    return results
+
+def _chunks(blocks):
+    chunk_size = config.BLOCK_CHECK_CHUNK_SIZE
+    for i in range(0, len(blocks), chunk_size):
+        yield [(block.serialize(header_only = block.transactions is None), block.transactions is None)
+               for block in blocks[i:i + chunk_size]]
+
+def _apply(blocks, results):
+    for block, (block_hash, error) in zip(blocks, results):
+        if error is not None:
+            raise error()
+        block.remember_hash(block_hash) # Not computed again when the block is pushed
+
+def check_blocks(blocks):
+    # Blockchain.check_block for every block, raising the error of the first invalid one.
+    executor = _get_executor()
+    futures = [executor.submit(_check_chunk, chunk) for chunk in _chunks(blocks)]
+    _apply(blocks, [result for future in futures for result in future.result()])
+
+def _done(future):
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+async def check_blocks_async(blocks):
+    # Same as check_blocks, for request handlers. Refused when too many tasks are waiting.
+    global _pending
+    chunks = list(_chunks(blocks))
+    with _pending_lock:
+        if _pending + len(chunks) > config.BLOCK_CHECK_MAX_PENDING:
+            raise VerificationBusy()
+        _pending += len(chunks)
+    executor = _get_executor()
+    futures = []
+    try:
+        for chunk in chunks:
+            future = executor.submit(_check_chunk, chunk)
+            future.add_done_callback(_done)
+            futures.append(future)
+    except Exception:
+        with _pending_lock:
+            _pending -= len(chunks) - len(futures)
+        raise
+    results = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+    _apply(blocks, [result for chunk in results for result in chunk])
@@ -6,6 +6,14 @@ class BlockNotFound(BlockchainException):
     def __init__(self):
         super().__init__('Block not found.')
 
+class BlockPruned(BlockchainException):
+    def __init__(self):
+        super().__init__('Block pruned.')
+
+class ForkTooDeep(BlockchainException):
+    def __init__(self):
+        super().__init__('Fork is deeper than the retained blocks.')
+
 class BlockTooLarge(BlockchainException):
     def __init__(self):
         super().__init__('Block too large.')
@@ -18,6 +26,10 @@ class BlockOld(BlockchainException):
     def __init__(self):
         super().__init__('Block is old.')
 
+class VerificationBusy(BlockchainException):
+    def __init__(self):
+        super().__init__('Too many blocks waiting for verification.')
+
 class InvalidIndex(BlockchainException):
     def __init__(self):
         super().__init__('Block index invalid.')
@@ -85,3 +97,19 @@ class MerkleTreeException(Exception):
 class HashNotFound(MerkleTreeException):
     def __init__(self):
         super().__init__('Hash not found in merkle tree leaves.')
+
+class SnapshotException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+class SnapshotCorrupted(SnapshotException):
+    def __init__(self):
+        super().__init__('Snapshot is corrupted.')
+
+class SnapshotHeightUnavailable(SnapshotException):
+    def __init__(self):
+        super().__init__('State of the requested height is not available.')
+
+class WorldNotEmpty(SnapshotException):
+    def __init__(self):
+        super().__init__('Snapshots can only be imported into an empty world.')
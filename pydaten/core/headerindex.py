@@ -0,0 +1,62 @@
+import struct
+from array import array
+
+HEADER_FORMAT = struct.Struct('>LL32s32sLL') # See Block.serialize
+
+class HeaderIndex:
+    # Timestamp, compressed difficulty and hash of the headers from 'start' on, in memory.
+    # The hash of a header is the previous hash of the next one, the tip hash is the one
+    # stored when it was pushed, or computed when asked for if there is none. Headers
+    # above 'height' are pushed by an import that is not flushed yet.
+
+    def __init__(self, start = 0):
+        self.start = start
+        self.height = start
+        self.timestamps = array('L')
+        self.difficulties = array('L')
+        self.hashes = []
+
+    def load(storage, prefix, hash_prefix):
+        index = None
+        for k, raw in storage.iterator(prefix = prefix):
+            block_index, timestamp, previous_hash, merkle_root, difficulty, nonce = HEADER_FORMAT.unpack_from(raw)
+            if index is None:
+                index = HeaderIndex(block_index)
+            index.append(timestamp, difficulty, previous_hash)
+        index = index or HeaderIndex()
+        index.height = index.top()
+        if index.height > index.start:
+            index.set_hash(index.height - 1, storage.get(hash_prefix + struct.pack('>L', index.height - 1)))
+        return index
+
+    def top(self):
+        return self.start + len(self.timestamps)
+
+    def append(self, timestamp, difficulty, previous_hash, block_hash = None):
+        if self.hashes:
+            self.hashes[-1] = previous_hash
+        self.timestamps.append(timestamp)
+        self.difficulties.append(difficulty)
+        self.hashes.append(block_hash)
+
+    def truncate(self, top):
+        count = max(top - self.start, 0)
+        del self.timestamps[count:]
+        del self.difficulties[count:]
+        del self.hashes[count:]
+        self.height = min(self.height, top)
+
+    def timestamp(self, index):
+        return self.timestamps[index - self.start]
+
+    def difficulty(self, index):
+        return self.difficulties[index - self.start]
+
+    def hash(self, index):
+        return self.hashes[index - self.start]
+
+    def set_hash(self, index, block_hash):
+        self.hashes[index - self.start] = block_hash
+
+    def timestamp_range(self, start, end):
+        return self.timestamps[start - self.start:end - self.start].tolist()
@@ -0,0 +1,99 @@
+import heapq
+import itertools
+import threading
+
+from pydaten.defaults import config
+from pydaten.utils.histogram import Histogram
+
+class Mempool:
+    # Transactions waiting for the block they target. The serialized size of the pool is
+    # capped, when it is full the transactions paying the least per byte are evicted.
+
+    def __init__(self, max_bytes = config.MEMPOOL_MAX_BYTES, target_window = config.MEMPOOL_TARGET_WINDOW):
+        self.max_bytes = max_bytes
+        self.target_window = target_window
+        self.size = 0
+        self.entries = {} # Hash -> (transaction, size, fee rate)
+        self.targets = {} # Target -> hashes
+        self.rates = [] # Heap of (fee rate, order, hash), removed entries are skipped when popped
+        self.order = itertools.count()
+        self.evicted = 0
+        self.expired = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, transaction_hash):
+        return transaction_hash in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, transaction, height):
+        # Returns False when the transaction is known, out of the target window or pays too little.
+        transaction_hash = transaction.calculate_hash()
+        size = len(transaction.serialize())
+        rate = transaction.fee / size
+        with self.lock:
+            if transaction_hash in self.entries:
+                return False
+            if transaction.target < height or transaction.target > height + self.target_window:
+                return False
+            if size > self.max_bytes:
+                return False
+            while self.size + size > self.max_bytes:
+                lowest = self._lowest()
+                if self.entries[lowest][2] >= rate:
+                    return False
+                self._remove(lowest)
+                self.evicted += 1
+            self.entries[transaction_hash] = (transaction, size, rate)
+            self.targets.setdefault(transaction.target, set()).add(transaction_hash)
+            heapq.heappush(self.rates, (rate, next(self.order), transaction_hash))
+            self.size += size
+            return True
+
+    def _lowest(self):
+        while self.rates[0][2] not in self.entries:
+            heapq.heappop(self.rates)
+        return self.rates[0][2]
+
+    def _remove(self, transaction_hash):
+        transaction, size, rate = self.entries.pop(transaction_hash)
+        hashes = self.targets[transaction.target]
+        hashes.discard(transaction_hash)
+        if not hashes:
+            del self.targets[transaction.target]
+        self.size -= size
+        if len(self.rates) > 2 * len(self.entries) + 64:
+            # Too many removed entries left in the heap.
+            self.rates = [item for item in self.rates if item[2] in self.entries]
+            heapq.heapify(self.rates)
+
+    def remove(self, transaction):
+        with self.lock:
+            transaction_hash = transaction.calculate_hash()
+            if transaction_hash in self.entries:
+                self._remove(transaction_hash)
+
+    def expire(self, height):
+        # Targets behind the tip can never be mined.
+        with self.lock:
+            for target in [t for t in self.targets if t < height]:
+                for transaction_hash in list(self.targets[target]):
+                    self._remove(transaction_hash)
+                    self.expired += 1
+
+    def transactions(self, target):
+        # Best paying first.
+        with self.lock:
+            entries = [self.entries[h] for h in self.targets.get(target, ())]
+        entries.sort(key = lambda entry: entry[2], reverse = True)
+        return [transaction for transaction, size, rate in entries]
+
+    def stats(self):
+        with self.lock:
+            fee_rates = Histogram()
+            for transaction, size, rate in self.entries.values():
+                fee_rates.add(rate)
+            return {'transactions': len(self.entries), 'bytes': self.size, 'maxBytes': self.max_bytes,
+                    'targets': {target: len(hashes) for target, hashes in sorted(self.targets.items())},
+                    'evicted': self.evicted, 'expired': self.expired, 'feeRates': fee_rates.json()}
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+import hashlib
+import struct
+
+from pydaten.defaults import config
+from pydaten.core.world import World, ENTRY_INLINE, _inline, _decode_undo, _entry_position
+from pydaten.core.errors import *
+
+MAGIC = b'DATENSNP'
+VERSION = 1
+
+STATE_PREFIXES = [World.BALANCE_PREFIX, World.RESOLVE_PREFIX, World.SHORTCUT_PREFIX, World.TRANSACTION_PREFIX, World.CHILDREN_PREFIX]
+ALLOWED_PREFIXES = STATE_PREFIXES + [World.HEADER_PREFIX, World.BODY_PREFIX]
+
+class _HashingWriter:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hasher = hashlib.sha256()
+
+    def write(self, raw):
+        self.hasher.update(raw)
+        self.stream.write(raw)
+
+    def write_record(self, key, value):
+        self.write(struct.pack('>L', len(key)) + key + struct.pack('>L', len(value)) + value)
+
+class _HashingReader:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hasher = hashlib.sha256()
+
+    def read(self, count):
+        raw = self.stream.read(count)
+        if len(raw) != count:
+            raise SnapshotCorrupted()
+        self.hasher.update(raw)
+        return raw
+
+    def read_uint32(self):
+        return struct.unpack('>L', self.read(4))[0]
+
+def _rewind(snapshot, height, tip):
+    # Walk the undo records from the tip down to the requested height. Lower blocks are
+    # visited last, so the balances left in the map are the ones at the requested height.
+    balances = {}
+    children = {}
+    removed = set()
+    for index in range(tip - 1, height - 1, -1):
+        undo = snapshot.get(World.UNDO_PREFIX + struct.pack('>L', index))
+        if undo is None:
+            raise SnapshotHeightUnavailable()
+        block_balances, names, history = _decode_undo(undo)
+        for raw, balance in block_balances:
+            balances[raw.public_key] = balance
+        for addr_key, k in names:
+            removed.update([World.SHORTCUT_PREFIX + addr_key, World.RESOLVE_PREFIX + addr_key, k])
+            parent_key, child = _entry_position(k)
+            children[parent_key] = min(child, children.get(parent_key, child))
+    return (balances, children, removed)
+
+def export_snapshot(world, stream, height = None):
+    snapshot = world.root.snapshot()
+    tip = snapshot.get(World.HEIGHT_PREFIX)
+    tip = struct.unpack('>L', tip)[0] if tip else 0
+    height = tip if height is None else height
+    pruned = snapshot.get(World.PRUNED_PREFIX)
+    pruned = struct.unpack('>L', pruned)[0] if pruned else 0
+    # The body of the block below the snapshot height is part of it.
+    if height < 1 or height > tip or height <= pruned:
+        snapshot.close()
+        raise SnapshotHeightUnavailable()
+    balances, children, removed = _rewind(snapshot, height, tip)
+
+    writer = _HashingWriter(stream)
+    writer.write(MAGIC + struct.pack('>LL', VERSION, height))
+
+    for k, v in snapshot.iterator(prefix = World.BALANCE_PREFIX):
+        public_key = k[len(World.BALANCE_PREFIX):]
+        if public_key in balances:
+            balance = balances.pop(public_key)
+            if balance == 0:
+                continue
+            v = struct.pack('>Q', balance)
+        writer.write_record(k, v)
+    for public_key, balance in balances.items():
+        if balance != 0:
+            writer.write_record(World.BALANCE_PREFIX + public_key, struct.pack('>Q', balance))
+
+    for k, v in snapshot.iterator(prefix = World.CHILDREN_PREFIX):
+        parent_key = k[len(World.CHILDREN_PREFIX):]
+        if parent_key in children:
+            if children[parent_key] == 0:
+                continue
+            v = struct.pack('>L', children[parent_key])
+        writer.write_record(k, v)
+
+    for prefix in [World.RESOLVE_PREFIX, World.SHORTCUT_PREFIX]:
+        for k, v in snapshot.iterator(prefix = prefix):
+            if k not in removed:
+                writer.write_record(k, v)
+
+    # Bodies are not part of a snapshot, name entries carry their transaction instead.
+    bodies = {}
+    for k, v in snapshot.iterator(prefix = World.TRANSACTION_PREFIX):
+        if k in removed:
+            continue
+        if v[0] != ENTRY_INLINE:
+            tag, index, position, offset, length = struct.unpack('>BLLLL', v)
+            if index not in bodies:
+                bodies.clear() # Entries of one parent are mostly registered in nearby blocks.
+                bodies[index] = snapshot.get(World.BODY_PREFIX + struct.pack('>L', index))
+            v = _inline(bodies[index][offset:offset + length])
+        writer.write_record(k, v)
+
+    start = max(height - config.SNAPSHOT_HEADERS, 0)
+    for k, v in snapshot.iterator(start = World.HEADER_PREFIX + struct.pack('>L', start),
+                                  stop = World.HEADER_PREFIX + struct.pack('>L', height)):
+        writer.write_record(k, v)
+    tip_body = World.BODY_PREFIX + struct.pack('>L', height - 1)
+    writer.write_record(tip_body, snapshot.get(tip_body))
+
+    writer.write(struct.pack('>L', 0))
+    digest = writer.hasher.digest()
+    stream.write(digest)
+    snapshot.close()
+    return digest
+
+def import_snapshot(world, stream):
+    if world.get_height() > 0:
+        raise WorldNotEmpty()
+    world.clear()
+    reader = _HashingReader(stream)
+    if reader.read(len(MAGIC)) != MAGIC or reader.read_uint32() != VERSION:
+        raise SnapshotCorrupted()
+    height = reader.read_uint32()
+
+    # Batches are written before the digest is checked. Until the import is done the
+    # marker stays, a world opened on what is left clears it.
+    world.root.put(World.IMPORTING_PREFIX, b'\x01')
+    wb = world.root.write_batch()
+    size = 0
+    try:
+        while True:
+            key_size = reader.read_uint32()
+            if key_size == 0:
+                break
+            key = reader.read(key_size)
+            if key[:1] not in ALLOWED_PREFIXES:
+                raise SnapshotCorrupted()
+            value = reader.read(reader.read_uint32())
+            wb.put(key, value)
+            size += key_size + len(value)
+            if size >= config.IMPORT_FLUSH_BYTES:
+                wb.write()
+                wb = world.root.write_batch()
+                size = 0
+        digest = reader.hasher.digest()
+        if stream.read(32) != digest:
+            raise SnapshotCorrupted()
+    except BaseException:
+        wb.clear()
+        world.clear()
+        raise
+
+    # Only the tip body is part of a snapshot, older blocks are treated as pruned.
+    wb.put(World.PRUNED_PREFIX, struct.pack('>L', height - 1))
+    # The height goes last, until it is written the world is still empty.
+    wb.put(World.HEIGHT_PREFIX, struct.pack('>L', height))
+    with world.commit_lock.write():
+        wb.write()
+        # Not part of a snapshot, the headers link them.
+        world._store_hashes()
+        world._index_hashes()
+        world.root.delete(World.IMPORTING_PREFIX)
+        world.generation += 1
+        world.block_cache.clear()
+        world.header_cache.clear()
+        world.name_cache.clear()
+        world.load_headers()
+    return digest
@@ -0,0 +1,571 @@
+#!/usr/bin/python3
+
+import bisect
+import lzma
+import threading
+import time
+import weakref
+import zlib
+from abc import ABC, abstractmethod
+
+import plyvel
+
+from pydaten.utils.histogram import Histogram
+
+class Storage(ABC):
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def put(self, key, value):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def iterator(self, prefix = None, start = None, stop = None, reverse = False, include_key = True, include_value = True):
+        pass
+
+    @abstractmethod
+    def write_batch(self, sync = False):
+        pass
+
+    @abstractmethod
+    def snapshot(self):
+        pass
+
+    def close(self):
+        pass
+
+class LevelDBStorage(Storage):
+
+    def __init__(self, path):
+        self.db = plyvel.DB(path, create_if_missing = True, paranoid_checks = True)
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def delete(self, key):
+        self.db.delete(key)
+
+    def iterator(self, prefix = None, start = None, stop = None, reverse = False, include_key = True, include_value = True):
+        if prefix is not None:
+            return self.db.iterator(prefix = prefix, reverse = reverse, include_key = include_key, include_value = include_value)
+        return self.db.iterator(start = start, stop = stop, reverse = reverse, include_key = include_key, include_value = include_value)
+
+    def write_batch(self, sync = False):
+        return self.db.write_batch(sync = sync)
+
+    def snapshot(self):
+        return self.db.snapshot() # Has the read methods of a Storage
+
+    def close(self):
+        self.db.close()
+
+def _prefix_stop(prefix):
+    # Smallest key greater than every key starting with prefix.
+    prefix = prefix.rstrip(b'\xff')
+    return prefix[:-1] + bytes([prefix[-1] + 1]) if prefix else None
+
+class _MemoryIterator:
+    # Walks the keys from 'low' to 'high', reading values as it goes. The keys and values
+    # are not changed meanwhile, see MemoryStorage.
+
+    def __init__(self, keys, values, low, high, reverse, include_key, include_value):
+        self.keys = keys
+        self.values = values
+        self.low = low
+        self.high = high
+        self.reverse = reverse
+        self.include_key = include_key
+        self.include_value = include_value
+        self.position = high - 1 if reverse else low
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position < self.low or self.position >= self.high:
+            raise StopIteration()
+        k = self.keys[self.position]
+        self.position += -1 if self.reverse else 1
+        if self.include_key and self.include_value:
+            return (k, self.values[k])
+        return k if self.include_key else self.values[k]
+
+    def seek(self, target):
+        position = bisect.bisect_left(self.keys, target, self.low, self.high)
+        self.position = position - 1 if self.reverse else position
+
+    def close(self):
+        pass
+
+class _MemoryWriteBatch:
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.operations = []
+
+    def put(self, key, value):
+        self.operations.append((key, value))
+
+    def delete(self, key):
+        self.operations.append((key, None))
+
+    def clear(self):
+        self.operations = []
+
+    def write(self):
+        for key, value in self.operations:
+            if value is None:
+                self.storage.delete(key)
+            else:
+                self.storage.put(key, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.write()
+
+class MemoryStorage(Storage):
+    # Iterators and snapshots share the keys and values, a write copies them first while
+    # any of them is still alive.
+
+    def __init__(self, values = None, keys = None):
+        self.values = values if values is not None else {}
+        self.keys = keys if keys is not None else sorted(self.values)
+        self.readers = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def _own(self):
+        if len(self.readers) > 0:
+            self.values = dict(self.values)
+            self.keys = list(self.keys)
+            self.readers = weakref.WeakSet()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            self._own()
+            if key not in self.values:
+                bisect.insort(self.keys, key)
+            self.values[key] = value
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.values:
+                self._own()
+                del self.values[key]
+                del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def iterator(self, prefix = None, start = None, stop = None, reverse = False, include_key = True, include_value = True):
+        if prefix is not None:
+            start, stop = (prefix, _prefix_stop(prefix))
+        with self.lock:
+            # Like a LevelDB iterator, later writes are not seen.
+            keys, values = (self.keys, self.values)
+            low = bisect.bisect_left(keys, start) if start is not None else 0
+            high = bisect.bisect_left(keys, stop) if stop is not None else len(keys)
+            iterator = _MemoryIterator(keys, values, low, high, reverse, include_key, include_value)
+            self.readers.add(iterator)
+        return iterator
+
+    def write_batch(self, sync = False):
+        return _MemoryWriteBatch(self)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = MemoryStorage(self.values, self.keys)
+            snapshot.readers.add(self)
+            self.readers.add(snapshot)
+        return snapshot
+
+class _OverlayIterator:
+    # Merges the iterator of the storage below with the written items in the same range,
+    # the written ones win and deleted ones are skipped.
+
+    def __init__(self, base, keys, values, reverse, include_key, include_value):
+        self.base = base
+        self.keys = keys # Sorted
+        self.values = values # Of the keys, None marks a deleted key
+        self.reverse = reverse
+        self.include_key = include_key
+        self.include_value = include_value
+        self.position = len(keys) - 1 if reverse else 0
+        self.next_base = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            if self.next_base is None:
+                self.next_base = next(self.base, None)
+            written = (self.keys[self.position], self.values[self.position]) if 0 <= self.position < len(self.keys) else None
+            if self.next_base is None and written is None:
+                raise StopIteration()
+            if written is None or (self.next_base is not None and
+                                   (written[0] < self.next_base[0] if self.reverse else written[0] > self.next_base[0])):
+                k, v = self.next_base
+                self.next_base = None
+            else:
+                if self.next_base is not None and self.next_base[0] == written[0]:
+                    self.next_base = None
+                self.position += -1 if self.reverse else 1
+                k, v = written
+                if v is None:
+                    continue
+            if self.include_key and self.include_value:
+                return (k, v)
+            return k if self.include_key else v
+
+    def seek(self, target):
+        self.base.seek(target)
+        self.next_base = None
+        if self.reverse:
+            self.position = bisect.bisect_left(self.keys, target) - 1
+        else:
+            self.position = bisect.bisect_left(self.keys, target)
+
+    def close(self):
+        self.base.close()
+
+class OverlayStorage(Storage):
+    # Reads fall through to the storage below, writes stay in memory. See World.merge.
+
+    def __init__(self, storage, values = None, keys = None):
+        self.storage = storage
+        self.values = values if values is not None else {} # None marks a deleted key
+        self.keys = keys if keys is not None else sorted(self.values)
+
+    def get(self, key):
+        if key in self.values:
+            return self.values[key]
+        return self.storage.get(key)
+
+    def put(self, key, value):
+        if key not in self.values:
+            bisect.insort(self.keys, key)
+        self.values[key] = value
+
+    def delete(self, key):
+        if key not in self.values:
+            bisect.insort(self.keys, key)
+        self.values[key] = None
+
+    def iterator(self, prefix = None, start = None, stop = None, reverse = False, include_key = True, include_value = True):
+        if prefix is not None:
+            start, stop = (prefix, _prefix_stop(prefix))
+        low = bisect.bisect_left(self.keys, start) if start is not None else 0
+        high = bisect.bisect_left(self.keys, stop) if stop is not None else len(self.keys)
+        # Like a LevelDB iterator, later writes are not seen.
+        keys = self.keys[low:high]
+        base = self.storage.iterator(start = start, stop = stop, reverse = reverse)
+        return _OverlayIterator(base, keys, [self.values[k] for k in keys], reverse, include_key, include_value)
+
+    def write_batch(self, sync = False):
+        return _MemoryWriteBatch(self)
+
+    def snapshot(self):
+        return OverlayStorage(self.storage.snapshot(), dict(self.values), list(self.keys))
+
+# A compressed value is the marker, the codec id and the compressed bytes. Values of the
+# compressed keyspaces never start with the marker otherwise, so untagged values are
+# read as they are and both kinds live side by side.
+CODEC_MARKER = 0xff
+CODECS = {'zlib': (1, zlib.compress, zlib.decompress),
+          'lzma': (2, lzma.compress, lzma.decompress)}
+_DECOMPRESSORS = {codec_id: decompress for codec_id, compress, decompress in CODECS.values()}
+
+class _DecodingIterator:
+
+    def __init__(self, iterator, storage, include_key):
+        self.iterator = iterator # Yields keys too, they tell whether a value can be compressed.
+        self.storage = storage
+        self.include_key = include_key
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        k, v = next(self.iterator)
+        v = self.storage.decode(k, v)
+        return (k, v) if self.include_key else v
+
+    def seek(self, target):
+        self.iterator.seek(target)
+
+    def close(self):
+        self.iterator.close()
+
+class _EncodingWriteBatch:
+
+    def __init__(self, batch, storage):
+        self.batch = batch
+        self.storage = storage
+
+    def put(self, key, value):
+        self.batch.put(key, self.storage.encode(key, value))
+
+    def delete(self, key):
+        self.batch.delete(key)
+
+    def clear(self):
+        self.batch.clear()
+
+    def write(self):
+        self.batch.write()
+
+    def __enter__(self):
+        self.batch.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.batch.__exit__(exc_type, exc_value, traceback)
+
+class CompressedStorage(Storage):
+    # Compresses the values of some keyspaces, values stored without a codec stay readable.
+    # With no codec nothing new is compressed, but compressed values are still read.
+
+    def __init__(self, storage, codec, prefixes, min_size = 0):
+        if codec is not None and codec not in CODECS:
+            raise ValueError("Unknown codec!")
+        self.storage = storage
+        self.codec = codec
+        self.prefixes = tuple(prefixes)
+        self.min_size = min_size
+
+    def encode(self, key, value):
+        if self.codec is None or len(value) < self.min_size or not key.startswith(self.prefixes):
+            return value
+        codec_id, compress, decompress = CODECS[self.codec]
+        compressed = bytes([CODEC_MARKER, codec_id]) + compress(value)
+        return compressed if len(compressed) < len(value) else value
+
+    def decode(self, key, value):
+        if value and value[0] == CODEC_MARKER and key.startswith(self.prefixes):
+            return _DECOMPRESSORS[value[1]](value[2:])
+        return value
+
+    def get(self, key):
+        return self.decode(key, self.storage.get(key))
+
+    def put(self, key, value):
+        self.storage.put(key, self.encode(key, value))
+
+    def delete(self, key):
+        self.storage.delete(key)
+
+    def iterator(self, prefix = None, start = None, stop = None, reverse = False, include_key = True, include_value = True):
+        # Ranges within a keyspace that is never compressed need no decoding.
+        scope = prefix if prefix is not None else (start if start and stop and start[:1] == stop[:1] else None)
+        if not include_value or (scope is not None and not scope.startswith(self.prefixes)):
+            return self.storage.iterator(prefix = prefix, start = start, stop = stop, reverse = reverse,
+                                         include_key = include_key, include_value = include_value)
+        iterator = self.storage.iterator(prefix = prefix, start = start, stop = stop, reverse = reverse)
+        return _DecodingIterator(iterator, self, include_key)
+
+    def write_batch(self, sync = False):
+        return _EncodingWriteBatch(self.storage.write_batch(sync = sync), self)
+
+    def snapshot(self):
+        return CompressedStorage(self.storage.snapshot(), self.codec, self.prefixes, self.min_size)
+
+    def close(self):
+        self.storage.close()
+
+class _KeyspaceStats:
+
+    def __init__(self):
+        self.gets = 0
+        self.get_bytes = 0
+        self.misses = 0
+        self.puts = 0
+        self.put_bytes = 0
+        self.deletes = 0
+        self.reads = 0 # Items read through iterators
+        self.read_bytes = 0
+
+    def json(self):
+        return dict(self.__dict__)
+
+class _Counters:
+    # Shared by an instrumented storage and its snapshots. Latencies are in microseconds.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.keyspaces = {}
+            self.latency = {'get': Histogram(), 'iterate': Histogram(), 'write': Histogram()}
+            self.batch_operations = Histogram()
+            self.batch_bytes = Histogram()
+
+    def _keyspace(self, key):
+        prefix = key[:1]
+        if prefix not in self.keyspaces:
+            self.keyspaces[prefix] = _KeyspaceStats()
+        return self.keyspaces[prefix]
+
+    def record_get(self, key, value, start):
+        elapsed = (time.perf_counter() - start) * 1000000
+        with self.lock:
+            self.latency['get'].add(elapsed)
+            stats = self._keyspace(key)
+            stats.gets += 1
+            if value is None:
+                stats.misses += 1
+            else:
+                stats.get_bytes += len(key) + len(value)
+
+    def record_read(self, key, value, start):
+        elapsed = (time.perf_counter() - start) * 1000000
+        with self.lock:
+            self.latency['iterate'].add(elapsed)
+            stats = self._keyspace(key)
+            stats.reads += 1
+            stats.read_bytes += len(key) + len(value)
+
+    def record_batch(self, operations, start):
+        elapsed = (time.perf_counter() - start) * 1000000
+        with self.lock:
+            self.latency['write'].add(elapsed)
+            size = 0
+            for key, length in operations:
+                stats = self._keyspace(key)
+                if length is None:
+                    stats.deletes += 1
+                else:
+                    stats.puts += 1
+                    stats.put_bytes += len(key) + length
+                    size += len(key) + length
+            self.batch_operations.add(len(operations))
+            self.batch_bytes.add(size)
+
+    def json(self, names):
+        with self.lock:
+            return {'keyspaces': {names.get(prefix, prefix.hex()): stats.json() for prefix, stats in self.keyspaces.items()},
+                    'latency': {op: histogram.json() for op, histogram in self.latency.items()},
+                    'batches': {'operations': self.batch_operations.json(), 'bytes': self.batch_bytes.json()}}
+
+class _InstrumentedIterator:
+
+    def __init__(self, iterator, counters, include_key, include_value):
+        self.iterator = iterator # Yields keys too, they tell the keyspace.
+        self.counters = counters
+        self.include_key = include_key
+        self.include_value = include_value
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = next(self.iterator)
+        k, v = item if self.include_value else (item, b'')
+        self.counters.record_read(k, v, start)
+        if self.include_key and self.include_value:
+            return item
+        return k if self.include_key else v
+
+    def seek(self, target):
+        self.iterator.seek(target)
+
+    def close(self):
+        self.iterator.close()
+
+class _InstrumentedWriteBatch:
+
+    def __init__(self, batch, counters):
+        self.batch = batch
+        self.counters = counters
+        self.operations = []
+
+    def put(self, key, value):
+        self.operations.append((key, len(value)))
+        self.batch.put(key, value)
+
+    def delete(self, key):
+        self.operations.append((key, None))
+        self.batch.delete(key)
+
+    def clear(self):
+        self.operations = []
+        self.batch.clear()
+
+    def write(self):
+        start = time.perf_counter()
+        self.batch.write()
+        self.counters.record_batch(self.operations, start)
+        self.operations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.write()
+
+class InstrumentedStorage(Storage):
+    # Counts operations and bytes per keyspace, the first byte of a key, and keeps latency
+    # histograms. Every written batch, one per pushed block, is a sample of the batch histograms.
+
+    def __init__(self, storage, names = None, counters = None):
+        self.storage = storage
+        self.names = names or {}
+        self.counters = counters or _Counters()
+
+    def stats(self):
+        return self.counters.json(self.names)
+
+    def reset(self):
+        self.counters.reset()
+
+    def get(self, key):
+        start = time.perf_counter()
+        value = self.storage.get(key)
+        self.counters.record_get(key, value, start)
+        return value
+
+    def put(self, key, value):
+        with self.write_batch() as wb:
+            wb.put(key, value)
+
+    def delete(self, key):
+        with self.write_batch() as wb:
+            wb.delete(key)
+
+    def iterator(self, prefix = None, start = None, stop = None, reverse = False, include_key = True, include_value = True):
+        iterator = self.storage.iterator(prefix = prefix, start = start, stop = stop, reverse = reverse,
+                                         include_value = include_value)
+        return _InstrumentedIterator(iterator, self.counters, include_key, include_value)
+
+    def write_batch(self, sync = False):
+        return _InstrumentedWriteBatch(self.storage.write_batch(sync = sync), self.counters)
+
+    def snapshot(self):
+        # Reads of a snapshot are counted with the storage it was taken from.
+        return InstrumentedStorage(self.storage.snapshot(), self.names, self.counters)
+
+    def close(self):
+        self.storage.close()
+
+def keyspace_sizes(storage):
+    # Key count and bytes of keys and values per keyspace, read from every key.
+    sizes = {}
+    for k, v in storage.iterator():
+        count, size = sizes.get(k[:1], (0, 0))
+        sizes[k[:1]] = (count + 1, size + len(k) + len(v))
+    return sizes
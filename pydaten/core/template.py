@@ -0,0 +1,66 @@
+from pydaten.common.transaction import Transaction
+from pydaten.common.block import Block
+from pydaten.common.data import NoData
+from pydaten.utils import misc
+from pydaten.defaults import config
+
+HEADER_SIZE = 80 # See Block.serialize
+
+class BlockTemplate:
+    # The next block, filled best paying transaction first while it fits in MAX_BLOCK_SIZE.
+    # The serialized size is kept as transactions are added, the block itself is only
+    # assembled, fee and merkle root included, when asked for.
+
+    def __init__(self, index, timestamp, previous_hash, difficulty, miner, reward):
+        self.index = index
+        self.timestamp = timestamp
+        self.previous_hash = previous_hash
+        self.difficulty = difficulty
+        self.fee_transaction = Transaction(
+            version = config.VERSION, target = index, fee = 0,
+            name = misc.random_name(),
+            source = config.NOWHERE_NAME,
+            destination = miner,
+            amount = 0,
+            data = NoData(),
+            signature = b'')
+        self.reward_transaction = Transaction(
+            version = config.VERSION, target = index, fee = 0,
+            name = misc.random_name(),
+            source = config.SUPPLY_NAME,
+            destination = miner,
+            amount = reward,
+            data = NoData(),
+            signature = b'')
+        self.transactions = []
+        self.fees = 0
+        # Header, transaction count, and every transaction after its length.
+        self.size = HEADER_SIZE + 4
+        for transaction in [self.fee_transaction, self.reward_transaction]:
+            self.size += 4 + len(transaction.serialize())
+        self.block = None
+
+    def add(self, transaction):
+        size = 4 + len(transaction.serialize())
+        if self.size + size > config.MAX_BLOCK_SIZE:
+            return False
+        self.transactions.append(transaction)
+        self.fees += transaction.fee
+        self.size += size
+        self.block = None
+        return True
+
+    def add_all(self, transactions):
+        # Ones that do not fit are skipped, a smaller one after them may still fit.
+        for transaction in sorted(transactions, key = lambda t: t.fee / len(t.serialize()), reverse = True):
+            self.add(transaction)
+
+    def get_block(self):
+        if self.block is None:
+            # A new fee transaction, earlier blocks may still be mined. Its amount has a fixed size.
+            fee = self.fee_transaction
+            fee_transaction = Transaction(fee.version, fee.target, fee.fee, fee.name, fee.source, fee.destination,
+                                          self.fees, fee.data, fee.signature)
+            transactions = self.transactions + [fee_transaction, self.reward_transaction]
+            self.block = Block(self.index, self.timestamp, self.previous_hash, self.difficulty, transactions, 0)
+        return self.block
@@ -0,0 +1,79 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pydaten.crypto import ecdsa
+from pydaten.defaults import config
+
+# Signatures are verified on threads, coincurve does not hold the GIL while verifying.
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers = config.VERIFY_WORKERS)
+        return _executor
+
+def _verify(transaction, source):
+    try:
+        return ecdsa.verify(transaction.signable(), source.public_key, transaction.signature)
+    except Exception:
+        return False # Malformed signature
+
+def verify_signature(transaction, source, cache = None, transaction_hash = None):
+    # The cache keeps the (transaction hash, public key) pairs that have verified.
+    if cache is None:
+        return _verify(transaction, source)
+    key = (transaction_hash or transaction.calculate_hash()) + source.public_key
+    if cache.get(key):
+        return True
+    if _verify(transaction, source):
+        cache.put(key, True)
+        return True
+    return False
+
+def _verify_chunk(jobs, failed, cache):
+    for transaction, source, key in jobs:
+        if failed.is_set():
+            return True # Cancelled, another chunk has failed
+        if not _verify(transaction, source):
+            failed.set()
+            return False
+        if cache is not None:
+            cache.put(key, True)
+    return True
+
+class SignatureBatch:
+    # Verifies (transaction, source address, transaction hash) triples in chunks, stopping at
+    # the first failure. Pairs found in the cache are not verified again.
+
+    def __init__(self, jobs, cache = None, chunk_size = None):
+        chunk_size = chunk_size or config.VERIFY_CHUNK_SIZE
+        self.failed = threading.Event()
+        self.cache = cache
+        self.jobs = None
+        self.futures = []
+        jobs = [(transaction, source, transaction_hash + source.public_key) for transaction, source, transaction_hash in jobs]
+        if cache is not None:
+            jobs = [job for job in jobs if not cache.get(job[2])]
+        if config.VERIFY_WORKERS <= 1 or len(jobs) <= chunk_size:
+            self.jobs = jobs # Not worth a thread, verified in wait
+        else:
+            executor = _get_executor()
+            for i in range(0, len(jobs), chunk_size):
+                self.futures.append(executor.submit(_verify_chunk, jobs[i:i + chunk_size], self.failed, cache))
+
+    def wait(self):
+        if self.jobs is not None:
+            return _verify_chunk(self.jobs, self.failed, self.cache)
+        for future in self.futures:
+            if not future.result():
+                self.cancel()
+                return False
+        return not self.failed.is_set()
+
+    def cancel(self):
+        self.failed.set()
+        for future in self.futures:
+            future.cancel()
@@ -1,61 +1,447 @@
-import plyvel
+import threading
 
 from pydaten.common.transaction import Transaction
 from pydaten.common.block import Block
 from pydaten.common.address import Address, RawAddress, NameAddress
 from pydaten.utils.bytestream import ByteStream
+from pydaten.utils.lru import LRUCache
+from pydaten.utils.rwlock import RWLock
+from pydaten.core.storage import Storage, LevelDBStorage, CompressedStorage, InstrumentedStorage, OverlayStorage
+from pydaten.core.headerindex import HeaderIndex
 from pydaten.defaults import genesis, config
+from pydaten.core.errors import BlockPruned
 import struct
 
 def _tx_key(name_address):
     return b'.'.join([n.encode('ascii') for n in reversed(name_address.name)])
 
+# Name entries point into the body of the block that registered them,
+# or carry the transaction itself when that body is not stored.
+ENTRY_REFERENCE = 0
+ENTRY_INLINE = 1
+
+def _reference(block_index, position, offset, length):
+    return struct.pack('>BLLLL', ENTRY_REFERENCE, block_index, position, offset, length)
+
+def _inline(raw):
+    return struct.pack('>B', ENTRY_INLINE) + raw
+
+def _entry_position(k):
+    # Name entry keys are TRANSACTION_PREFIX + parent key + '|' + index among the children.
+    return (k[1:-5], struct.unpack('>L', k[-4:])[0])
+
+def _encode_undo(balances, names, history):
+    # Balances before the block, the (name, entry key) pairs and the history keys it added.
+    stream = ByteStream()
+    stream.write_uint32(len(balances))
+    for raw, balance in balances:
+        stream.write(raw.public_key)
+        stream.write_uint64(balance)
+    stream.write_uint32(len(names))
+    for addr_key, k in names:
+        stream.write_uint16(len(addr_key))
+        stream.write(addr_key)
+        stream.write_uint16(len(k))
+        stream.write(k)
+    stream.write_uint32(len(history))
+    for k in history:
+        stream.write(k)
+    return stream.value()
+
+def _decode_undo(raw):
+    stream = ByteStream(raw)
+    balances = [(RawAddress(stream.read(33)), stream.read_uint64()) for i in range(stream.read_uint32())]
+    names = [(stream.read(stream.read_uint16()), stream.read(stream.read_uint16())) for i in range(stream.read_uint32())]
+    count = stream.read(4) # Records written by layout 1 have no history keys.
+    history = [stream.read(World.HISTORY_KEY_SIZE) for i in range(struct.unpack('>L', count)[0])] if count else []
+    return (balances, names, history)
+
+class _PendingBatch:
+    # Writes kept in memory, and readable, until they are flushed as a single batch.
+
+    def __init__(self, db):
+        self.db = db
+        self.values = {} # None marks a deleted key
+        self.size = 0
+
+    def get(self, key):
+        if key in self.values:
+            return self.values[key]
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.values[key] = value
+        self.size += len(key) + len(value)
+
+    def delete(self, key):
+        self.values[key] = None
+        self.size += len(key)
+
+    def write(self):
+        with self.db.write_batch(sync = True) as wb:
+            for k, v in self.values.items():
+                if v is None:
+                    wb.delete(k)
+                else:
+                    wb.put(k, v)
+        self.values = {}
+        self.size = 0
+
 class World:
+    LAYOUT_VERSION = 5
+
     HEIGHT_PREFIX = b'\x00'
     HEADER_PREFIX = b'\x01'
     TRANSACTION_PREFIX = b'\x06'
-    BLOCK_TRANSACTION_PREFIX = b'\x02'
+    BLOCK_TRANSACTION_PREFIX = b'\x02' # Only read while migrating from layout 0
     SHORTCUT_PREFIX = b'\x03'
     RESOLVE_PREFIX = b'\x04'
     BALANCE_PREFIX = b'\x05'
+    BODY_PREFIX = b'\x07'
+    LAYOUT_PREFIX = b'\x08'
+    UNDO_PREFIX = b'\x09'
+    HISTORY_PREFIX = b'\x0a' # Public key, height and position of every transaction touching an account
+    HISTORY_KEY_SIZE = 1 + 33 + 8
+    CHILDREN_PREFIX = b'\x0b'
+    PRUNED_PREFIX = b'\x0c' # Blocks below this height have no body, undo record or history
+    BLOCK_HASH_PREFIX = b'\x0d' # PoW hash of every header, kept when the block is pruned
+    HASH_PREFIX = b'\x0e' # Height of every header by its hash
+    IMPORTING_PREFIX = b'\x0f' # Set while a snapshot is imported, see snapshot.import_snapshot
+
+    COMPRESSED_PREFIXES = [HEADER_PREFIX, BODY_PREFIX, TRANSACTION_PREFIX]
+
+    def __init__(self, storage, prune_depth = None, codec = config.STORAGE_CODEC, instrument = config.STORAGE_STATS):
+        # A path opens the LevelDB database stored there.
+        storage = storage if isinstance(storage, Storage) else LevelDBStorage(storage)
+        # Counts what reaches the database, after compression. Not wrapped at all when off.
+        self.instrumented = InstrumentedStorage(storage, World.keyspaces()) if instrument else None
+        self.root = CompressedStorage(self.instrumented or storage, codec, World.COMPRESSED_PREFIXES, config.COMPRESSION_MIN_SIZE)
+        if prune_depth is not None and prune_depth < 1:
+            raise ValueError("Prune depth should be at least one block!")
+        self.prune_depth = prune_depth
+        self.block_cache = LRUCache(config.BLOCK_CACHE_SIZE)
+        self.header_cache = LRUCache(config.HEADER_CACHE_SIZE)
+        self.name_cache = LRUCache(config.NAME_CACHE_SIZE) # False marks an unknown name
+        self._local = threading.local()
+        # Commits take the write side. Counts commits, a cache entry read from storage
+        # before the last commit is not stored.
+        self.commit_lock = RWLock()
+        self.generation = 0
+        self.headers = None
+        if self.root.get(World.IMPORTING_PREFIX) is not None:
+            self.clear() # A snapshot import did not finish
+        self._migrate()
+        self.load_headers()
+
+    def keyspaces():
+        return {getattr(World, name): name[:-len('_PREFIX')].lower() for name in dir(World) if name.endswith('_PREFIX')}
 
-    def __init__(self, path):
-        self.root = plyvel.DB(path, create_if_missing = True, paranoid_checks = True)
+    @property
+    def _store(self):
+        # Only the importing thread sees blocks that are not flushed yet.
+        return getattr(self._local, 'pending', None) or self.root
+
+    def begin_import(self):
+        self._local.pending = _PendingBatch(self.root)
+    def import_size(self):
+        return self._local.pending.size
+    def flush_import(self):
+        pending = self._local.pending
+        names = [k[len(World.RESOLVE_PREFIX):] for k in pending.values if k.startswith(World.RESOLVE_PREFIX)]
+        with self.commit_lock.write():
+            pending.write()
+            self.generation += 1
+            self.headers.height = self.headers.top()
+            # Other threads may have cached these names before they were registered.
+            for key in names:
+                self.name_cache.pop(key)
+    def end_import(self):
+        self._local.pending = None # Unflushed blocks are dropped
+        self.headers.truncate(self.headers.height)
+
+    def view(self):
+        # A read-only world pinned to the current state.
+        with self.commit_lock.read():
+            return WorldView(self, self.root.snapshot())
+    def close(self):
+        self.root.close()
+
+    def load_headers(self):
+        with self.commit_lock.write():
+            self.headers = HeaderIndex.load(self.root, World.HEADER_PREFIX, World.BLOCK_HASH_PREFIX)
+
+    def _remember(self, cache, key, value, weight, generation):
+        if getattr(self._local, 'pending', None) is not None:
+            return # Other threads would see blocks that are not flushed yet.
+        with self.commit_lock.read():
+            if self.generation == generation:
+                cache.put(key, value, weight)
+
+    def clear(self):
+        # Everything but the layout version.
+        with self.root.write_batch() as wb:
+            for k in self.root.iterator(include_value = False):
+                if k != World.LAYOUT_PREFIX:
+                    wb.delete(k)
+
+    def get_layout(self):
+        result = self.root.get(World.LAYOUT_PREFIX)
+        return struct.unpack('>L', result)[0] if result else 0
+    def _migrate(self):
+        layout = self.get_layout()
+        if layout == 0:
+            # Layout 0 kept one pointer per transaction and the transaction itself under its name entry.
+            for index in range(self.get_height()):
+                prefix = World.BLOCK_TRANSACTION_PREFIX + struct.pack('>L', index)
+                pointers = list(self.root.iterator(prefix = prefix))
+                if not pointers:
+                    continue # Already migrated
+                body = ByteStream()
+                body.write_uint32(len(pointers))
+                offset = 4
+                with self.root.write_batch() as wb:
+                    for position, (pointer, k) in enumerate(pointers):
+                        raw = self.root.get(k)
+                        body.write_uint32(len(raw))
+                        body.write(raw)
+                        wb.put(k, _reference(index, position, offset + 4, len(raw)))
+                        offset += 4 + len(raw)
+                        wb.delete(pointer)
+                    wb.put(World.BODY_PREFIX + struct.pack('>L', index), body.value())
+        if layout < 2:
+            # Layout 2 added the per-account history index.
+            for index in range(self.get_height()):
+                body = self.root.get(World.BODY_PREFIX + struct.pack('>L', index))
+                transactions = Transaction.deserialize_list(body)
+                resolved = self.resolve_many([a for tx in transactions for a in (tx.source, tx.destination)])
+                undo = self.root.get(World.UNDO_PREFIX + struct.pack('>L', index))
+                offset = 4
+                history = []
+                with self.root.write_batch() as wb:
+                    for position, tx in enumerate(transactions):
+                        length = struct.unpack('>L', body[offset:offset + 4])[0]
+                        reference = _reference(index, position, offset + 4, length)
+                        offset += 4 + length
+                        history.extend(self._set_history(wb, index, position, reference,
+                                                         resolved[tx.source], resolved[tx.destination]))
+                    if undo is not None:
+                        balances, names, _ = _decode_undo(undo)
+                        wb.put(World.UNDO_PREFIX + struct.pack('>L', index), _encode_undo(balances, names, history))
+        if layout < 3:
+            # Layout 3 keeps a counter of children per parent.
+            with self.root.write_batch() as wb:
+                for k in self.root.iterator(prefix = World.TRANSACTION_PREFIX, include_value = False):
+                    parent_key, index = _entry_position(k)
+                    wb.put(World.CHILDREN_PREFIX + parent_key, struct.pack('>L', index + 1))
+        if layout < 4:
+            # Layout 4 stores the hash of every header.
+            self._store_hashes()
+        if layout < 5:
+            # Layout 5 finds headers by their hash.
+            self._index_hashes()
+        if layout != World.LAYOUT_VERSION:
+            self.root.put(World.LAYOUT_PREFIX, struct.pack('>L', World.LAYOUT_VERSION))
+
+    def _store_hashes(self):
+        # A header carries the hash of the one before it, only the top one is computed.
+        with self.root.write_batch() as wb:
+            previous = None
+            for k, raw in self.root.iterator(prefix = World.HEADER_PREFIX):
+                header = Block.deserialize(raw, header_only = True)
+                if previous is not None:
+                    wb.put(World.BLOCK_HASH_PREFIX + struct.pack('>L', previous.index), header.previous_hash)
+                previous = header
+            if previous is not None:
+                wb.put(World.BLOCK_HASH_PREFIX + struct.pack('>L', previous.index), previous.calculate_hash())
+
+    def _index_hashes(self):
+        with self.root.write_batch() as wb:
+            for k, block_hash in self.root.iterator(prefix = World.BLOCK_HASH_PREFIX):
+                wb.put(World.HASH_PREFIX + block_hash, k[len(World.BLOCK_HASH_PREFIX):])
 
     def push_block(self, block):
         height = self.get_height()
         if block.index == height:
-            with self.root.write_batch() as wb:
+            pending = getattr(self._local, 'pending', None)
+            if pending is not None:
+                self._set_height(pending, height + 1)
+                self._set_block(pending, block)
+                self._prune(pending, height + 1)
+                self._forget_names(block)
+                if self.headers is not None:
+                    self.headers.append(block.timestamp, block.difficulty, block.previous_hash, block.calculate_hash())
+            else:
+                wb = self.root.write_batch()
                 self._set_height(wb, height + 1)
                 self._set_block(wb, block)
+                self._prune(wb, height + 1)
+                with self.commit_lock.write():
+                    wb.write()
+                    self.generation += 1
+                    self._forget_names(block)
+                    if self.headers is not None:
+                        self.headers.append(block.timestamp, block.difficulty, block.previous_hash, block.calculate_hash())
+                        self.headers.height = self.headers.top()
         else:
             raise Exception("Block Index mismatch!")
     def pop_block(self):
-        latest = self.get_latest_block()
-        with self.root.write_batch() as wb:
-            self._set_height(wb, self.get_height() - 1)
-            self._clear_block(wb, latest.index)
+        if getattr(self._local, 'pending', None) is not None:
+            raise Exception("Cannot pop blocks while importing!")
+        if self.get_height() - 1 < self.get_pruned_height():
+            raise BlockPruned()
+        # Only the header is returned, the undo record is applied without reading the body.
+        latest = self.get_latest_header()
+        undo = self.root.get(World.UNDO_PREFIX + struct.pack('>L', latest.index))
+        wb = self.root.write_batch()
+        self._set_height(wb, self.get_height() - 1)
+        if undo is not None:
+            names = self._undo_block(wb, latest.index, undo)
+        else:
+            names = self._clear_block(wb, latest.index) # Pushed before undo records existed
+        with self.commit_lock.write():
+            wb.write()
+            self.generation += 1
+            self._forget_block(latest.index)
+            for addr_key in names:
+                self.name_cache.pop(addr_key)
+            if self.headers is not None:
+                self.headers.truncate(latest.index)
         return latest
 
+    def overlay(self):
+        # A world to try blocks on, its writes stay in memory until merged.
+        return WorldOverlay(self)
+    def merge(self, overlay):
+        # Commits the writes of an overlay of this world in one batch.
+        changes = overlay.root.values
+        names = [k[len(World.RESOLVE_PREFIX):] for k in changes if k.startswith(World.RESOLVE_PREFIX)]
+        height = overlay.get_height()
+        headers = overlay.get_header_range(overlay.low, height)
+        hashes = [overlay.get_block_hash(i) for i in range(overlay.low, height)]
+        wb = self.root.write_batch()
+        for k, v in changes.items():
+            if v is None:
+                wb.delete(k)
+            else:
+                wb.put(k, v)
+        with self.commit_lock.write():
+            previous_height = self.get_height()
+            previous_pruned = self.get_pruned_height()
+            wb.write()
+            self.generation += 1
+            for index in range(previous_pruned, overlay.get_pruned_height()):
+                self.block_cache.pop(index)
+            for index in range(overlay.low, max(previous_height, height)):
+                self._forget_block(index)
+            for key in names:
+                self.name_cache.pop(key)
+            if self.headers is not None:
+                self.headers.truncate(overlay.low)
+                for header, block_hash in zip(headers, hashes):
+                    self.headers.append(header.timestamp, header.difficulty, header.previous_hash, block_hash)
+                self.headers.height = self.headers.top()
+
     def resolve(self, address):
         if type(address) is RawAddress:
             return address
         else:
-            result = self.root.get(World.RESOLVE_PREFIX + _tx_key(address))
+            key = _tx_key(address)
+            generation = self.generation
+            result = self._pending_name(self._store, key)
+            if result is None:
+                result = self.name_cache.get(key)
+            if result is None:
+                raw = self._store.get(World.RESOLVE_PREFIX + key)
+                result = Address.read(ByteStream(raw)) if raw else False
+                self._remember(self.name_cache, key, result, 1, generation)
             if result:
-                return Address.read(ByteStream(result))
+                return result
             else:
                 raise Exception("Invalid name!")
 
-    def find_children(self, name_address):
-        prefix = World.TRANSACTION_PREFIX + _tx_key(name_address) + b'|'
-        result = []
-        for k, v in self.root.iterator(prefix = prefix):
-            result.append(Transaction.deserialize(v))
+    def _pending_name(self, store, key):
+        # Unflushed names come first, other threads may have cached them as unknown.
+        if isinstance(store, _PendingBatch):
+            pending = store.values.get(World.RESOLVE_PREFIX + key, False)
+            if pending is not False:
+                return Address.read(ByteStream(pending)) if pending else False
+        return None
+
+    def resolve_many(self, addresses):
+        store = self._store
+        generation = self.generation
+        result = {}
+        missing = {}
+        for address in addresses:
+            if address in result:
+                continue
+            if type(address) is RawAddress:
+                result[address] = address
+            else:
+                key = _tx_key(address)
+                cached = self._pending_name(store, key)
+                if cached is None:
+                    cached = self.name_cache.get(key)
+                if cached is None:
+                    missing[key] = address
+                else:
+                    result[address] = cached or None
+        if missing:
+            # Seek through the resolve keyspace in key order instead of issuing random gets.
+            it = self.root.iterator(prefix = World.RESOLVE_PREFIX)
+            for key in sorted(missing):
+                it.seek(World.RESOLVE_PREFIX + key)
+                found = next(it, None)
+                if found and found[0] == World.RESOLVE_PREFIX + key:
+                    raw = Address.read(ByteStream(found[1]))
+                else:
+                    raw = False
+                self._remember(self.name_cache, key, raw, 1, generation)
+                result[missing[key]] = raw or None
+            it.close()
         return result
 
+    def _forget_names(self, block):
+        for tx in block.transactions:
+            self.name_cache.pop(_tx_key(tx.address()))
+
+    def find_children(self, name_address, after = None, limit = None):
+        return list(self.iter_children(name_address, after, limit))
+
+    def iter_children(self, name_address, after = None, limit = None):
+        # Children are numbered from zero in registration order, 'after' is the last one already seen.
+        prefix = World.TRANSACTION_PREFIX + _tx_key(name_address) + b'|'
+        start = prefix + struct.pack('>L', after + 1) if after is not None else prefix
+        bodies = {}
+        for k, v in self.root.iterator(start = start, stop = prefix + b'\xff' * 5):
+            if limit is not None and limit <= 0:
+                break
+            if limit is not None:
+                limit -= 1
+            yield self._read_entry(v, bodies)
+
+    def count_children(self, name_address):
+        return self._child_count(name_address)
+
+    def _read_entry(self, entry, bodies = None):
+        if entry[0] == ENTRY_INLINE:
+            return Transaction.deserialize(entry[1:])
+        tag, index, position, offset, length = struct.unpack('>BLLLL', entry)
+        block = self.block_cache.get(index) if index in self.block_cache else None
+        if block is not None:
+            return block.transactions[position]
+        body = bodies.get(index) if bodies is not None else None
+        if body is None:
+            body = self._store.get(World.BODY_PREFIX + struct.pack('>L', index))
+            if bodies is not None:
+                bodies[index] = body
+        return Transaction.deserialize(body[offset:offset + length])
+
     def get_height(self):
-        result = self.root.get(World.HEIGHT_PREFIX)
+        if self.headers is not None:
+            # The importing thread also sees the headers it has not flushed.
+            return self.headers.top() if getattr(self._local, 'pending', None) is not None else self.headers.height
+        result = self._store.get(World.HEIGHT_PREFIX)
         return struct.unpack('>L', result)[0] if result else 0
     def _set_height(self, wb, height):
         if height > 0:
@@ -63,90 +449,291 @@ class World:
         else:
             wb.delete(World.HEIGHT_PREFIX)
 
-    def _set_transaction(self, wb, index, transaction):
+    def _set_transaction(self, wb, index, transaction, source, reference):
         addr = transaction.address()
         name, rest = addr.pop()
         k = World.TRANSACTION_PREFIX + _tx_key(rest) + b'|' + struct.pack('>L', index)
-        wb.put(k, transaction.serialize())
+        wb.put(k, reference)
         addr_key = _tx_key(addr)
         wb.put(World.SHORTCUT_PREFIX + addr_key, k)
         bs = ByteStream()
-        src = self.resolve(transaction.source)
-        src.write(bs)
+        source.write(bs)
         wb.put(World.RESOLVE_PREFIX + addr_key, bs.value())
-        dst = self.resolve(transaction.destination)
-        return k
+        self.name_cache.pop(addr_key)
+        return (addr_key, k)
     def find(self, name_address):
-        k = self.root.get(World.SHORTCUT_PREFIX + _tx_key(name_address))
-        return Transaction.deserialize(self.root.get(k))
+        k = self._store.get(World.SHORTCUT_PREFIX + _tx_key(name_address))
+        return self._read_entry(self._store.get(k))
     def _clear_transaction(self, wb, name_address):
         addr_key = _tx_key(name_address)
-        k = self.root.get(World.SHORTCUT_PREFIX + addr_key)
+        k = self._store.get(World.SHORTCUT_PREFIX + addr_key)
         wb.delete(World.SHORTCUT_PREFIX + addr_key)
         wb.delete(World.RESOLVE_PREFIX + addr_key)
+        self.name_cache.pop(addr_key)
         wb.delete(k)
+        return k
 
     def _child_count(self, name):
-        prefix = World.TRANSACTION_PREFIX + _tx_key(name) + b'|'
-        try:
-            latest = next(self.root.iterator(prefix = prefix, reverse = True, include_value = False))
-            latest = latest[len(prefix):len(prefix)+4]
-            return struct.unpack('>L', latest)[0] + 1
-        except StopIteration:
-            return 0
+        result = self._store.get(World.CHILDREN_PREFIX + _tx_key(name))
+        return struct.unpack('>L', result)[0] if result else 0
+    def _set_child_count(self, wb, parent_key, count):
+        if count > 0:
+            wb.put(World.CHILDREN_PREFIX + parent_key, struct.pack('>L', count))
+        else:
+            wb.delete(World.CHILDREN_PREFIX + parent_key)
+    def _restore_child_counts(self, wb, entry_keys):
+        # Entries are only removed from the end, the lowest removed index is the previous count.
+        counts = {}
+        for k in entry_keys:
+            parent_key, index = _entry_position(k)
+            counts[parent_key] = min(index, counts.get(parent_key, index))
+        for parent_key, count in counts.items():
+            self._set_child_count(wb, parent_key, count)
 
     def _set_block(self, wb, block):
         wb.put(World.HEADER_PREFIX + struct.pack('>L', block.index), block.serialize(header_only = True))
+        wb.put(World.BLOCK_HASH_PREFIX + struct.pack('>L', block.index), block.calculate_hash())
+        wb.put(World.HASH_PREFIX + block.calculate_hash(), struct.pack('>L', block.index))
         balance = {}
         indices = {}
+        names = []
+        history = []
+        body = ByteStream()
+        body.write_uint32(len(block.transactions))
+        offset = 4
+        resolved = self.resolve_many([a for tx in block.transactions for a in (tx.source, tx.destination)])
         for ind, tx in enumerate(block.transactions):
+            src = resolved[tx.source]
+            dst = resolved[tx.destination]
+            if src is None or dst is None:
+                raise Exception("Invalid name!")
+            raw = tx.serialize()
+            body.write_uint32(len(raw))
+            body.write(raw)
+            reference = _reference(block.index, ind, offset + 4, len(raw))
+            offset += 4 + len(raw)
             parent = tx.address().pop()[1]
             indices[parent] = self._child_count(parent) if parent not in indices else indices[parent] + 1
-            k = self._set_transaction(wb, indices[parent], tx)
-            wb.put(World.BLOCK_TRANSACTION_PREFIX + struct.pack('>LL', block.index, ind), k)
-            src = self.resolve(tx.source)
-            dst = self.resolve(tx.destination)
+            names.append(self._set_transaction(wb, indices[parent], tx, src, reference))
+            history.extend(self._set_history(wb, block.index, ind, reference, src, dst))
             if src not in balance:
                 balance[src] = 0
             if dst not in balance:
                 balance[dst] = 0
             balance[src] -= (tx.fee + tx.amount)
             balance[dst] += tx.amount
+        wb.put(World.BODY_PREFIX + struct.pack('>L', block.index), body.value())
+        for parent, index in indices.items():
+            self._set_child_count(wb, _tx_key(parent), index + 1)
+        balances = []
         for raw, bal in balance.items():
             if raw != config.NOWHERE_NAME:
-                self._set_balance(wb, raw, self.get_balance(raw) + bal)
+                previous = self.get_balance(raw)
+                balances.append((raw, previous))
+                self._set_balance(wb, raw, previous + bal)
+        wb.put(World.UNDO_PREFIX + struct.pack('>L', block.index), _encode_undo(balances, names, history))
+    def _set_history(self, wb, index, position, reference, source, destination):
+        keys = []
+        for raw in {source, destination}:
+            k = World.HISTORY_PREFIX + raw.public_key + struct.pack('>LL', index, position)
+            wb.put(k, reference)
+            keys.append(k)
+        return keys
+    def history(self, raw_address, before = None, limit = config.QUERY_MAX_TRANSACTIONS):
+        # Newest transactions first, a block is never split between two pages.
+        prefix = World.HISTORY_PREFIX + raw_address.public_key
+        stop = prefix + (struct.pack('>L', before) if before is not None else b'\xff' * 9)
+        result = []
+        bodies = {}
+        last_height = None
+        for k, v in self.root.iterator(start = prefix, stop = stop, reverse = True):
+            height = struct.unpack('>L', k[len(prefix):len(prefix) + 4])[0]
+            if len(result) >= limit and height != last_height:
+                break
+            last_height = height
+            result.append(self._read_entry(v, bodies))
+        result.reverse()
+        return result
+    def get_header(self, index):
+        generation = self.generation
+        header = self.header_cache.get(index)
+        if header is None:
+            header = Block.deserialize(self._store.get(World.HEADER_PREFIX + struct.pack('>L', index)), header_only = True)
+            self._remember(self.header_cache, index, header, 1, generation)
+        return header
+    def get_header_range(self, start, end):
+        return [self.get_header(i) for i in range(start, end)]
+    def _indexed(self, index):
+        return self.headers is not None and self.headers.start <= index < self.get_height()
+    def get_timestamp(self, index):
+        return self.headers.timestamp(index) if self._indexed(index) else self.get_header(index).timestamp
+    def get_timestamps(self, start, end):
+        if self._indexed(start) and self._indexed(end - 1):
+            return self.headers.timestamp_range(start, end)
+        return [self.get_timestamp(i) for i in range(start, end)]
+    def get_difficulty(self, index):
+        return self.headers.difficulty(index) if self._indexed(index) else self.get_header(index).difficulty
+    def get_block_hash(self, index):
+        if not self._indexed(index):
+            block_hash = self._store.get(World.BLOCK_HASH_PREFIX + struct.pack('>L', index))
+            return block_hash or self.get_header(index).calculate_hash()
+        block_hash = self.headers.hash(index)
+        if block_hash is None:
+            generation = self.generation
+            block_hash = self.get_header(index).calculate_hash()
+            # Only a tip without a stored hash is computed, keep it unless it was popped meanwhile.
+            with self.commit_lock.read():
+                if self.generation == generation:
+                    self.headers.set_hash(index, block_hash)
+        return block_hash
+    def get_header_start(self):
+        # The lowest stored header, a world imported from a snapshot has none below it.
+        if self.headers is not None:
+            return self.headers.start
+        for k in self._store.iterator(prefix = World.HEADER_PREFIX, include_value = False):
+            return struct.unpack('>L', k[len(World.HEADER_PREFIX):])[0]
+        return 0
+    def get_height_by_hash(self, block_hash):
+        # The index of the block, None when it is not on the chain.
+        result = self._store.get(World.HASH_PREFIX + block_hash)
+        return struct.unpack('>L', result)[0] if result else None
+    def _clear_header(self, wb, index):
+        wb.delete(World.HEADER_PREFIX + struct.pack('>L', index))
+        block_hash = self._store.get(World.BLOCK_HASH_PREFIX + struct.pack('>L', index))
+        if block_hash is not None:
+            wb.delete(World.HASH_PREFIX + block_hash)
+        wb.delete(World.BLOCK_HASH_PREFIX + struct.pack('>L', index))
     def get_block(self, index):
-        block = Block.deserialize(self.root.get(World.HEADER_PREFIX + struct.pack('>L', index)), header_only = True)
-        prefix = World.BLOCK_TRANSACTION_PREFIX + struct.pack('>L', index)
-        txs = list(self.root.iterator(prefix = prefix, include_key = False))
-        block.transactions = [Transaction.deserialize(self.root.get(tx)) for tx in txs]
+        generation = self.generation
+        block = self.block_cache.get(index)
+        if block is None:
+            if index < self.get_pruned_height():
+                raise BlockPruned()
+            raw_header = self._store.get(World.HEADER_PREFIX + struct.pack('>L', index))
+            raw_body = self._store.get(World.BODY_PREFIX + struct.pack('>L', index))
+            block = self._decode_block(index, raw_header, raw_body, generation)
+        return block
+    def get_block_range(self, start, end):
+        if start < end and start < self.get_pruned_height():
+            raise BlockPruned()
+        generation = self.generation
+        result = []
+        headers = self.root.iterator(start = World.HEADER_PREFIX + struct.pack('>L', start),
+                                     stop = World.HEADER_PREFIX + struct.pack('>L', end), include_key = False)
+        bodies = self.root.iterator(start = World.BODY_PREFIX + struct.pack('>L', start),
+                                    stop = World.BODY_PREFIX + struct.pack('>L', end), include_key = False)
+        for index, raw_header, raw_body in zip(range(start, end), headers, bodies):
+            block = self.block_cache.get(index)
+            result.append(block if block is not None else self._decode_block(index, raw_header, raw_body, generation))
+        headers.close()
+        bodies.close()
+        return result
+    def _decode_block(self, index, raw_header, raw_body, generation):
+        block = Block.deserialize(raw_header, header_only = True)
+        block.transactions = Transaction.deserialize_list(raw_body)
+        self._remember(self.block_cache, index, block, len(raw_header) + len(raw_body), generation)
         return block
+    def _forget_block(self, index):
+        self.block_cache.pop(index)
+        self.header_cache.pop(index)
+    def cache_stats(self):
+        return {'blocks': self.block_cache.stats(), 'headers': self.header_cache.stats()}
+    def storage_stats(self):
+        return self.instrumented.stats() if self.instrumented is not None else None
     def _clear_block(self, wb, index):
-        wb.delete(World.HEADER_PREFIX + struct.pack('>L', index))
-        prefix = World.BLOCK_TRANSACTION_PREFIX + struct.pack('>L', index)
+        self._forget_block(index)
+        self._clear_header(wb, index)
+        body_key = World.BODY_PREFIX + struct.pack('>L', index)
         balance = {}
-        for tx in self.root.iterator(prefix = prefix, include_value = False):
-            transact = Transaction.deserialize(self.root.get(self.root.get(tx)))
+        transactions = Transaction.deserialize_list(self._store.get(body_key))
+        # Resolve before any name of this block is cleared.
+        resolved = self.resolve_many([a for tx in transactions for a in (tx.source, tx.destination)])
+        entry_keys = []
+        names = []
+        for position, transact in enumerate(transactions):
             addr = transact.address()
-            self._clear_transaction(wb, addr)
-            src = self.resolve(transact.source)
-            dst = self.resolve(transact.destination)
+            entry_keys.append(self._clear_transaction(wb, addr))
+            names.append(_tx_key(addr))
+            src = resolved[transact.source]
+            dst = resolved[transact.destination]
+            for raw in {src, dst}:
+                wb.delete(World.HISTORY_PREFIX + raw.public_key + struct.pack('>LL', index, position))
             if src not in balance:
                 balance[src] = 0
             if dst not in balance:
                 balance[dst] = 0
             balance[src] += (transact.fee + transact.amount)
             balance[dst] -= transact.amount
-            wb.delete(tx)
+        self._restore_child_counts(wb, entry_keys)
+        wb.delete(body_key)
         for raw, bal in balance.items():
             if raw != config.NOWHERE_NAME:
                 self._set_balance(wb, raw, self.get_balance(raw) + bal)
+        return names
+    def _undo_block(self, wb, index, undo):
+        self._forget_block(index)
+        balances, names, history = _decode_undo(undo)
+        for addr_key, k in names:
+            wb.delete(World.SHORTCUT_PREFIX + addr_key)
+            wb.delete(World.RESOLVE_PREFIX + addr_key)
+            self.name_cache.pop(addr_key)
+            wb.delete(k)
+        self._restore_child_counts(wb, [k for addr_key, k in names])
+        for k in history:
+            wb.delete(k)
+        for raw, balance in balances:
+            self._set_balance(wb, raw, balance)
+        self._clear_header(wb, index)
+        wb.delete(World.BODY_PREFIX + struct.pack('>L', index))
+        wb.delete(World.UNDO_PREFIX + struct.pack('>L', index))
+        return [addr_key for addr_key, k in names]
+    def get_pruned_height(self):
+        result = self._store.get(World.PRUNED_PREFIX)
+        return struct.unpack('>L', result)[0] if result else 0
+    def _prune(self, wb, height):
+        if self.prune_depth is None:
+            return
+        pruned = self.get_pruned_height()
+        # Catch up gradually when pruning is enabled on an existing chain.
+        end = min(height - self.prune_depth, pruned + config.PRUNE_BATCH_BLOCKS)
+        for index in range(pruned, end):
+            self._prune_block(wb, index)
+        if end > pruned:
+            wb.put(World.PRUNED_PREFIX, struct.pack('>L', end))
+    def _prune_block(self, wb, index):
+        self.block_cache.pop(index)
+        body_key = World.BODY_PREFIX + struct.pack('>L', index)
+        body = self._store.get(body_key)
+        undo = self._store.get(World.UNDO_PREFIX + struct.pack('>L', index))
+        if undo is not None:
+            balances, names, history = _decode_undo(undo)
+            entry_keys = [k for addr_key, k in names]
+        else:
+            transactions = Transaction.deserialize_list(body)
+            entry_keys = [self._store.get(World.SHORTCUT_PREFIX + _tx_key(tx.address())) for tx in transactions]
+            resolved = self.resolve_many([a for tx in transactions for a in (tx.source, tx.destination)])
+            history = [World.HISTORY_PREFIX + raw.public_key + struct.pack('>LL', index, position)
+                       for position, tx in enumerate(transactions)
+                       for raw in {resolved[tx.source], resolved[tx.destination]}]
+        # Names registered by the block outlive its body, they keep a copy of their transaction.
+        for k in entry_keys:
+            entry = self._store.get(k)
+            if entry[0] == ENTRY_INLINE:
+                continue # Imported from a snapshot
+            tag, block_index, position, offset, length = struct.unpack('>BLLLL', entry)
+            wb.put(k, _inline(body[offset:offset + length]))
+        for k in history:
+            wb.delete(k)
+        wb.delete(body_key)
+        wb.delete(World.UNDO_PREFIX + struct.pack('>L', index))
     def get_latest_block(self):
         return self.get_block(self.get_height() - 1)
+    def get_latest_header(self):
+        return self.get_header(self.get_height() - 1)
 
     def get_balance(self, raw_address):
         k = World.BALANCE_PREFIX + raw_address.public_key
-        result = self.root.get(k)
+        result = self._store.get(k)
         return struct.unpack('>Q', result)[0] if result else 0
     def _set_balance(self, wb, raw_address, balance):
         k = World.BALANCE_PREFIX + raw_address.public_key
@@ -154,3 +741,97 @@ class World:
             wb.put(k, struct.pack('>Q', balance))
         else:
             wb.delete(k) # No need to store balance when it is zero.
+
+class _ViewCache:
+    # The cache of a world holds for its views until the next commit, what a view reads
+    # from its snapshot stays with the view.
+
+    def __init__(self, view, shared):
+        self.view = view
+        self.shared = shared
+        self.local = {}
+
+    def get(self, key, default = None):
+        if key in self.local:
+            return self.local[key]
+        value = self.shared.get(key)
+        # Checked after the read, a commit in between may have replaced the entry.
+        if value is not None and self.view.world.generation == self.view.generation:
+            return value
+        return default
+
+    def put(self, key, value, weight = 1):
+        self.local[key] = value
+
+    def pop(self, key):
+        self.local.pop(key, None)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return self.shared.stats()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+class WorldView(World):
+    # The state of a world when the view was taken. Reads need no lock and stay
+    # repeatable while blocks are pushed or popped on the world.
+
+    def __init__(self, world, snapshot):
+        self.root = snapshot
+        self.world = world
+        self.prune_depth = world.prune_depth
+        self.generation = world.generation
+        self.block_cache = _ViewCache(self, world.block_cache)
+        self.header_cache = _ViewCache(self, world.header_cache)
+        self.name_cache = _ViewCache(self, world.name_cache)
+        self.headers = None # The index follows the world, the view reads its headers.
+        self._local = threading.local()
+
+    def view(self):
+        return self
+
+    def close(self):
+        self.root.close()
+
+    def _remember(self, cache, key, value, weight, generation):
+        cache.put(key, value, weight)
+
+    def push_block(self, block):
+        raise Exception("World view is read-only!")
+    def pop_block(self):
+        raise Exception("World view is read-only!")
+    def begin_import(self):
+        raise Exception("World view is read-only!")
+
+class WorldOverlay(World):
+    # A world on top of another one, reading through to it. What is pushed or popped
+    # stays in memory, see World.merge. It has caches of its own, the ones of the world
+    # below would hold blocks and names the overlay has popped.
+
+    def __init__(self, world):
+        self.root = OverlayStorage(world.root)
+        self.world = world
+        self.prune_depth = world.prune_depth
+        self.instrumented = None
+        self.generation = 0
+        self.block_cache = LRUCache(config.BLOCK_CACHE_SIZE)
+        self.header_cache = LRUCache(config.HEADER_CACHE_SIZE)
+        self.name_cache = LRUCache(config.NAME_CACHE_SIZE)
+        self.headers = None # Read from the overlay, like a view
+        self.commit_lock = RWLock()
+        self._local = threading.local()
+        self.low = world.get_height() # Blocks from this height on are replaced when merged
+        self.generation_below = world.generation
+
+    def pop_block(self):
+        latest = World.pop_block(self)
+        self.low = min(self.low, latest.index)
+        return latest
+
+    def view(self):
+        raise Exception("World overlay has no views!")
+    def begin_import(self):
+        raise Exception("World overlay cannot import!")
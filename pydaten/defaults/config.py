@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import hashlib
+import os
 from argon2.low_level import hash_secret_raw, Type
 
 from pydaten.core import difficulty
@@ -11,7 +12,36 @@ MAX_PEERS = 128
 HEARTBEAT_INTERVAL = 60 # Seconds
 BAD_PEER_BAN_TIME = 60 # Seconds
 
-QUERY_MAX_BLOCKS = 100
+QUERY_MAX_TRANSACTIONS = 100
+QUERY_MAX_CHILDREN = 1000
+LOCATOR_DENSE_HASHES = 10 # Hashes of the last blocks in a block locator, the ones below are further and further apart
+LOCATOR_MAX_HASHES = 64 # Hashes of a peer's locator looked up
+
+BLOCK_CACHE_SIZE = 64 * 1024 * 1024 # Bytes of decoded blocks
+HEADER_CACHE_SIZE = 4096 # Headers
+NAME_CACHE_SIZE = 65536 # Resolved names
+
+IMPORT_FLUSH_BLOCKS = 500
+IMPORT_FLUSH_BYTES = 64 * 1024 * 1024 # 64MBs
+PRUNE_BATCH_BLOCKS = 100 # Blocks pruned at most per pushed block
+SNAPSHOT_HEADERS = 1000 # Headers before the snapshot height kept in a snapshot
+STORAGE_CODEC = None # 'zlib' or 'lzma' to compress stored blocks and name entries
+COMPRESSION_MIN_SIZE = 64 # Smaller values are stored as they are
+STORAGE_STATS = False # Count storage operations per keyspace, see World.storage_stats
+
+VERIFY_WORKERS = os.cpu_count() or 1 # Threads verifying the signatures of a block
+VERIFY_CHUNK_SIZE = 64 # Signatures per task
+SIGNATURE_CACHE_SIZE = 65536 # Verified (transaction, public key) pairs
+BLOCK_CHECK_WORKERS = os.cpu_count() or 1 # Processes checking the PoW and merkle root of received blocks
+BLOCK_CHECK_CHUNK_SIZE = 16 # Blocks per task
+BLOCK_CHECK_MAX_PENDING = 256 # Tasks of request handlers queued or running, more are refused
+SYNC_HEADERS = 2000 # Headers downloaded and checked per synchronization round
+SYNC_WINDOW = 100 # Blocks per download
+SYNC_DOWNLOADS = 4 # Windows downloaded at once
+SYNC_WINDOWS_AHEAD = 8 # Downloaded windows waiting to be connected, at most
+
+MEMPOOL_MAX_BYTES = 32 * 1024 * 1024 # 32MBs of serialized transactions
+MEMPOOL_TARGET_WINDOW = 10 # Blocks ahead of the tip a pooled transaction may target
 
 SUPPLY = 18446744073709551615 # 18,446,744,073.709551615
 MAX_TRANSACTIONS_PER_BLOCK = 2000
@@ -13,6 +13,7 @@ CONTRIBUTORS_INITIAL_BALANCE = SUPPLY // 5 # 20% of all assets
 SUPPLY_INITIAL_BALANCE = SUPPLY - FOUNDER_INITIAL_BALANCE - CONTRIBUTORS_INITIAL_BALANCE
 GENESIS_TIMESTAMP = 1514628754
 GENESIS_NONCE = 259
+GENESIS_HASH = bytes.fromhex('00082dff1bf8bda0e40970994b7229843464bbc8363b08e99e4dd5e609b31166')
 
 def genesis_block():
     supply_account = Transaction(
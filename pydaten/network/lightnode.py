@@ -16,6 +16,8 @@ class LightNode:
     TRANSACTIONS_URL = "http://{}/transactions"
     BLOCK_URL = "http://{}/blocks/{}"
     BLOCKS_RANGE_URL = "http://{}/blocks/{}/{}"
+    BLOCK_HASH_URL = "http://{}/blocks/hash/{}"
+    BLOCK_LOCATOR_URL = "http://{}/blocks/locator"
     BLOCKS_URL = "http://{}/blocks"
     TRANSACTION_HISTORY_URL = "http://{}/address/{}/transactions"
     BALANCE_URL = "http://{}/address/{}/balance"
@@ -31,7 +33,7 @@ class LightNode:
     def random_peers(self):
         good_peers = self.all_peers()
         count = min(len(good_peers), config.MAX_PEERS)
-        return random.sample(good_peers, count)
+        return random.sample(list(good_peers), count)
 
     def set_bad_peer(self, peer):
         self.bad_peers[peer] = int(time.time())
@@ -72,11 +74,11 @@ class LightNode:
             response = requests.get(url)
             if response.status_code == 200:
                 try:
-                    return Block.deserialize(requests.get(url).content, header_only = header_only)
+                    return Block.deserialize(response.content, header_only = header_only)
                 except CommonException:
-                    self.set_bad_peer(node)
+                    self.set_bad_peer(peer)
         except requests.exceptions.RequestException as re:
-            self.set_bad_peer(node)
+            self.set_bad_peer(peer)
 
     def get_block(self, index, header_only = False):
         hashes = set()
@@ -90,6 +92,30 @@ class LightNode:
                     hashes.add(block_hash)
         return blocks
 
+    def get_block_by_hash_from(self, block_hash, peer, header_only = False):
+        url = self.BLOCK_HASH_URL.format(peer, block_hash.hex())
+        if header_only:
+            url += '?header'
+        try:
+            response = requests.get(url)
+            if response.status_code == 200 and response.content:
+                try:
+                    return Block.deserialize(response.content, header_only = header_only)
+                except CommonException:
+                    self.set_bad_peer(peer)
+        except requests.exceptions.RequestException as re:
+            self.set_bad_peer(peer)
+
+    def find_fork_from(self, locator, peer):
+        # Height of the last block we share with the peer, see Blockchain.get_locator.
+        url = self.BLOCK_LOCATOR_URL.format(peer)
+        try:
+            response = requests.post(url, data = b''.join(locator))
+            if response.status_code == 200:
+                return response.json()['height']
+        except requests.exceptions.RequestException as re:
+            self.set_bad_peer(peer)
+
     def get_status_from(self, peer):
         url = self.STATUS_URL.format(peer)
         try:
@@ -97,7 +123,7 @@ class LightNode:
             if response.status_code == 200:
                 return response.json()
         except requests.exceptions.RequestException as re:
-            self.set_bad_peer(node)
+            self.set_bad_peer(peer)
 
     def get_block_range_from(self, start, end, peer, header_only = False):
         url = self.BLOCKS_RANGE_URL.format(peer, start, end)
@@ -107,11 +133,11 @@ class LightNode:
             response = requests.get(url)
             if response.status_code == 200:
                 try:
-                    return Block.deserialize_list(requests.get(url).content, header_only = header_only)
+                    return Block.deserialize_list(response.content, header_only = header_only)
                 except CommonException:
-                    self.set_bad_peer(node)
+                    self.set_bad_peer(peer)
         except requests.exceptions.RequestException as re:
-            self.set_bad_peer(node)
+            self.set_bad_peer(peer)
 
     def send_transaction_to(self, peer, transaction):
         url = LightNode.TRANSACTIONS_URL.format(peer)
@@ -119,7 +145,7 @@ class LightNode:
             response = requests.post(url, data = transaction.serialize())
             return response.json()
         except requests.exceptions.RequestException:
-            self.set_bad_peer(node)
+            self.set_bad_peer(peer)
 
 if __name__ == '__main__':
     ln = LightNode()
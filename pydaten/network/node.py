@@ -12,11 +12,15 @@ import io
 import asyncio
 import subprocess
 import os
+import struct
 from queue import Queue
 import pkg_resources
 
 from pydaten.network.lightnode import LightNode
+from pydaten.network.sync import Synchronizer
 from pydaten.core.blockchain import Blockchain
+from pydaten.core.mempool import Mempool
+from pydaten.core.blockcheck import check_blocks_async
 from pydaten.common.transaction import Transaction
 from pydaten.common.block import Block
 from pydaten.defaults import config
@@ -37,7 +41,7 @@ class Node(LightNode):
         resp.headers['ACCESS-CONTROL-ALLOW-ORIGIN'] = '*'
         return resp
 
-    def __init__(self, host, ip, port, path, initial_peers, username, password):
+    def __init__(self, host, ip, port, path, initial_peers, username, password, prune_depth = None, codec = config.STORAGE_CODEC, instrument = config.STORAGE_STATS):
         super().__init__(initial_peers)
 
         self.path = path
@@ -46,13 +50,14 @@ class Node(LightNode):
         self.password = password
 
         print("Loading the blockchain...")
-        self.blockchain = Blockchain(self.path)
+        self.blockchain = Blockchain(self.path, prune_depth, codec, instrument)
 
         print("Starting a full-node on " + self.host + "...")
         self.block_queue = Queue()
         self.transaction_queue = Queue()
-        self.transaction_pool = {}
+        self.mempool = Mempool()
         self.next_block = None
+        self.sent_blocks = {} # Blocks sent to the miner, by merkle root
 
         self.mining_interrupt = threading.Condition()
 
@@ -72,11 +77,15 @@ class Node(LightNode):
         app.router.add_static('/static/', path = os.path.join(RESOURCES_PATH, 'static'))
         app.router.add_get('/', self.index)
         app.router.add_route('*', '/blocks', self.blocks)
+        app.router.add_post('/blocks/locator', self.block_locator) # Before the routes they would match
+        app.router.add_get('/blocks/hash/{hash}', self.block_by_hash)
         app.router.add_get('/blocks/{index}', self.block)
         app.router.add_get('/blocks/{start}/{end}', self.block_range)
         app.router.add_route('*', '/peers', self.nodes)
         app.router.add_route('*', '/transactions', self.transactions)
         app.router.add_get('/status', self.status)
+        app.router.add_get('/stats', self.stats)
+        app.router.add_get('/mempool', self.mempool_stats)
         app.router.add_get('/find', self.find)
         app.router.add_get('/latest', self.latest)
         app.router.add_get('/resolve', self.resolve)
@@ -145,12 +154,6 @@ class Node(LightNode):
             except requests.exceptions.RequestException:
                 self.set_bad_peer(node)
 
-    def transaction_exists(self, tx):
-        for t in self.transaction_pool[tx.target]:
-            if t.calculate_hash() == tx.calculate_hash():
-                return True
-        return False
-
     async def index(self, request):
         with io.open(os.path.join(RESOURCES_PATH, 'index.html')) as f:
             html = f.read()
@@ -159,6 +162,13 @@ class Node(LightNode):
     async def status(self, request):
         return web.json_response(data = {'height' : self.blockchain.get_height(), 'time' : self.get_time(), 'bytePrice': self.byte_price})
 
+    async def stats(self, request):
+        return web.json_response(data = {'caches': self.blockchain.world.cache_stats(),
+                                         'storage': self.blockchain.world.storage_stats()})
+
+    async def mempool_stats(self, request):
+        return web.json_response(data = self.mempool.stats())
+
     async def transactions(self, request):
         if request.method == 'GET':
             return web.json_response(data=[tx.json() for tx in self.blockchain.transactions])
@@ -185,75 +195,156 @@ class Node(LightNode):
         elif request.method == 'POST':
             try:
                 b = Block.deserialize(await request.content.read())
-                self.blockchain.is_valid_block(b)
+                # Stale blocks are refused before they take a place in the verification pool.
+                self.blockchain.check_block_state(b)
+                await check_blocks_async([b])
                 self.block_queue.put(b)
                 return web.json_response(data = {'ok' : True})
             except (CommonException, BlockchainException) as e:
                 return web.json_response(data = {'ok' : False, 'error': str(e)})
 
     async def block(self, request):
-        header_only = 'header' in request.query
-        index = request.match_info['index']
-        if index == 'latest':
-            index = self.blockchain.get_height() - 1
-        else:
-            index = int(index)
-        if index < self.blockchain.get_height():
-            return web.Response(body=self.blockchain.get_block(index).serialize(header_only = header_only))
+        view = self.blockchain.view()
+        try:
+            header_only = 'header' in request.query
+            index = request.match_info['index']
+            if index == 'latest':
+                index = view.get_height() - 1
+            else:
+                index = int(index)
+            return self.block_response(view, index, header_only)
+        finally:
+            view.close()
+
+    async def block_by_hash(self, request):
+        view = self.blockchain.view()
+        try:
+            header_only = 'header' in request.query
+            try:
+                index = view.get_height_by_hash(bytes.fromhex(request.match_info['hash']))
+            except ValueError:
+                return web.json_response(data = {'ok': False, 'error': 'Invalid hash!'}, status = 400)
+            if index is None:
+                return web.Response(body=b'')
+            return self.block_response(view, index, header_only)
+        finally:
+            view.close()
+
+    async def block_locator(self, request):
+        # The fork point of a peer sending its block locator, None when not even the genesis block is shared.
+        raw = (await request.content.read())[:config.LOCATOR_MAX_HASHES * 32]
+        locator = [raw[i:i + 32] for i in range(0, len(raw) - len(raw) % 32, 32)]
+        view = self.blockchain.view()
+        try:
+            return web.json_response(data = {'ok': True, 'height': view.find_fork(locator)})
+        finally:
+            view.close()
+
+    def block_response(self, view, index, header_only):
+        if index < view.get_height() and header_only:
+            return web.Response(body=view.get_header(index).serialize(header_only = True))
+        elif index < view.get_height():
+            try:
+                return web.Response(body=view.get_block(index).serialize())
+            except BlockPruned as e:
+                return web.json_response(data = {'ok': False, 'error': str(e)}, status = 410)
         else:
             return web.Response(body=b'')
 
     async def block_range(self, request):
-        header_only = 'header' in request.query
-        start = int(request.match_info['start'])
-        end = request.match_info['end']
-        if end == 'latest':
-            end = self.blockchain.get_height()
-        else:
-            end = int(end) + 1
-            end = min(self.blockchain.get_height(), end)
-        if end > start:
-            result = self.blockchain.get_block_range(start, end)
-        else:
-            result = []
-        return web.Response(body=Block.serialize_list(result, header_only = header_only))
+        view = self.blockchain.view()
+        try:
+            header_only = 'header' in request.query
+            start = int(request.match_info['start'])
+            end = request.match_info['end']
+            if end == 'latest':
+                end = view.get_height()
+            else:
+                end = int(end) + 1
+                end = min(view.get_height(), end)
+            if end > start and header_only:
+                result = view.get_header_range(start, end)
+            elif end > start:
+                try:
+                    result = view.get_block_range(start, end)
+                except BlockPruned as e:
+                    return web.json_response(data = {'ok': False, 'error': str(e)}, status = 410)
+            else:
+                result = []
+            return web.Response(body=Block.serialize_list(result, header_only = header_only))
+        finally:
+            view.close()
 
     async def find(self, request):
-        children = 'children' in request.query
-        name = Address.from_string(request.query.get('name', None))
-        if not children:
-            tx = self.blockchain.find(name)
-            return web.Response(body=tx.serialize())
-        else:
-            txs = self.blockchain.find_children(name)
-            return web.Response(body=Transaction.serialize_list(txs))
+        view = self.blockchain.view()
+        try:
+            children = 'children' in request.query
+            name = Address.from_string(request.query.get('name', None))
+            if not children:
+                tx = view.find(name)
+                return web.Response(body=tx.serialize())
+            else:
+                after = request.query.get('after', None)
+                after = int(after) if after is not None else None
+                limit = min(int(request.query.get('limit', config.QUERY_MAX_CHILDREN)), config.QUERY_MAX_CHILDREN)
+                first = after + 1 if after is not None else 0
+                count = max(min(view.count_children(name) - first, limit), 0)
+                # Same layout as Transaction.serialize_list, written one transaction at a time.
+                # The view stays open until the last one is written, or the client goes away.
+                response = web.StreamResponse()
+                await response.prepare(request)
+                await response.write(struct.pack('>L', count))
+                for tx in view.iter_children(name, after, count):
+                    serialized = tx.serialize()
+                    await response.write(struct.pack('>L', len(serialized)) + serialized)
+                await response.write_eof()
+                return response
+        finally:
+            view.close()
 
     async def latest(self, request):
-        address = Address.from_string(request.query.get('address'))
-        txs = self.blockchain.latest(address = address)
-        return web.Response(body=Transaction.serialize_list(txs))
+        view = self.blockchain.view()
+        try:
+            address = Address.from_string(request.query.get('address'))
+            before = request.query.get('before', None)
+            before = int(before) if before is not None else None
+            limit = int(request.query.get('limit', config.QUERY_MAX_TRANSACTIONS))
+            txs = view.latest(address, before, limit)
+            return web.Response(body=Transaction.serialize_list(txs))
+        finally:
+            view.close()
 
     async def resolve(self, request):
-        address = request.query.get('address', None)
-        raw_name = self.blockchain.resolve(Address.from_string(address))
-        if raw_name is None:
-            return web.json_response({'ok': False, 'error': 'Invalid address.'})
-        return web.json_response(data = {
-            'balance': self.blockchain.get_balance(raw_name)
-        })
-
-    async def confirm(self, request):
-        index = int(request.query['target'])
-        hashed = bytes.fromhex(request.query['hash'])
+        view = self.blockchain.view()
         try:
+            address = request.query.get('address', None)
+            raw_name = view.resolve(Address.from_string(address))
+            if raw_name is None:
+                return web.json_response({'ok': False, 'error': 'Invalid address.'})
             return web.json_response(data = {
-                'ok': True,
-                'path': self.blockchain.get_block(index).get_merkle_path(hashed).hex()
+                'balance': view.get_balance(raw_name)
             })
-        except IndexError:
-            return web.json_response(data = { 'ok': False, 'error': 'Block not mined yet!' })
-        except Exception as e:
-            return web.json_response(data = { 'ok': False, 'error': str(e) })
+        finally:
+            view.close()
+
+    async def confirm(self, request):
+        view = self.blockchain.view()
+        try:
+            index = int(request.query['target'])
+            hashed = bytes.fromhex(request.query['hash'])
+            try:
+                return web.json_response(data = {
+                    'ok': True,
+                    'path': view.get_block(index).get_merkle_path(hashed).hex()
+                })
+            except IndexError:
+                return web.json_response(data = { 'ok': False, 'error': 'Block not mined yet!' })
+            except BlockPruned as e:
+                return web.json_response(data = { 'ok': False, 'pruned': True, 'error': str(e) })
+            except Exception as e:
+                return web.json_response(data = { 'ok': False, 'error': str(e) })
+        finally:
+            view.close()
 
     async def live(self, request):
         address = request.query.get('address', None)
@@ -284,11 +375,11 @@ class Node(LightNode):
 
 
     def block_broadcaster(self):
-        latest_index = self.blockchain.get_latest_block().index
+        latest_index = self.blockchain.get_height() - 1
         while True:
             b = self.block_queue.get()
             try:
-                if b.index > self.blockchain.get_latest_block().index + 1:
+                if b.index > self.blockchain.get_height():
                     # Synchronize just with that peer!
                     self.synchronize()
                 else:
@@ -300,10 +391,10 @@ class Node(LightNode):
                             self.blockchain.push_block(b)
                     except:
                         pass
-                if latest_index != self.blockchain.get_latest_block().index:
-                    latest_block = self.blockchain.get_latest_block()
-                    latest_index = latest_block.index
-                    print("Block {} - {}".format(latest_block.index,latest_block.calculate_hash().hex()))
+                if latest_index != self.blockchain.get_height() - 1:
+                    latest_index = self.blockchain.get_height() - 1
+                    self.mempool.expire(latest_index + 1)
+                    print("Block {} - {}".format(latest_index, self.blockchain.get_block_hash(latest_index).hex()))
 
                 coro = self.mine_next_block()
                 asyncio.run_coroutine_threadsafe(coro, self.app.loop)
@@ -311,25 +402,21 @@ class Node(LightNode):
             except Exception as ex:
                 print("An unhandled exception occurred!", ex)
 
-    def transaction_exists(self, transaction):
-        if transaction.target not in self.transaction_pool:
-            return False
-        for tx in self.transaction_pool[transaction.target]:
-            if tx.calculate_hash() == transaction.calculate_hash():
-                return True
-        return False
-
     def transaction_broadcaster(self):
         while True:
             tx = self.transaction_queue.get()
             try:
-                if tx.target not in self.transaction_pool:
-                    self.transaction_pool[tx.target] = []
-                if self.transaction_exists(tx):
-                    continue
+                if not self.mempool.add(tx, self.blockchain.get_height()):
+                    continue # Known, out of the target window or pays too little to fit
                 else:
                     print("New transaction!")
-                    self.transaction_pool[tx.target].append(tx)
+                if self.miner is not None and self.next_block and tx.target == self.next_block.index:
+                    # Goes into the block being mined, the miner gets the new template.
+                    try:
+                        self.blockchain.add_transaction(tx)
+                        asyncio.run_coroutine_threadsafe(self.mine_next_block(), self.app.loop)
+                    except BlockchainException:
+                        self.mempool.remove(tx)
 
                 raw_name = self.blockchain.resolve(tx.destination)
                 if raw_name in self.listeners:
@@ -341,61 +428,51 @@ class Node(LightNode):
                 print("An unhandled exception occurred!", ex)
 
     def synchronize_with(self, peer):
-        latest_block = self.blockchain.get_latest_block()
-        remote_diff_blocks = self.get_block_range_from(latest_block.index + 1, 'latest', peer)
-        if len(remote_diff_blocks) > 0:
-            if remote_diff_blocks[0].previous_hash == latest_block.calculate_hash():
-                for block in remote_diff_blocks:
-                    try:
-                        self.blockchain.push_block(block)
-                    except:
-                        self.set_bad_peer(peer)
-                        break
-            else:
-                for i in range(latest_block.index, 0, -1):
-                    block = self.get_block_from(i, peer)
-                    remote_diff_blocks.insert(0, block)
-                    if block.previous_hash == self.blockchain.get_block(i - 1).calculate_hash():
-                        self.blockchain.fork(remote_diff_blocks)
-                        break
+        Synchronizer(self, peer).run()
 
     def synchronize(self):
-        latest_block = self.blockchain.get_latest_block()
+        latest_index = self.blockchain.get_height() - 1
         latest_blocks = {}
         for node in self.random_peers():
             remote_block = self.get_block_from('latest', node, True)
-            if remote_block and remote_block.index > latest_block.index:
+            if remote_block and remote_block.index > latest_index:
                 if remote_block.index not in latest_blocks:
                     latest_blocks[remote_block.index] = {}
-                remote_hash = remote_block.calculate_hash()
-                if remote_hash not in latest_blocks[remote_block.index]:
-                    latest_blocks[remote_block.index][remote_hash] = []
-                latest_blocks[remote_block.index][remote_hash].append(node)
+                # Peers on the same block send the same header, no need to hash it.
+                remote_header = remote_block.serialize(header_only = True)
+                if remote_header not in latest_blocks[remote_block.index]:
+                    latest_blocks[remote_block.index][remote_header] = []
+                latest_blocks[remote_block.index][remote_header].append(node)
         if len(latest_blocks) > 0:
-            for index, hash_nodes in sorted(latest_blocks.items(), reverse=True):
-                for hashed, nodes in hash_nodes.items():
-                    latest_block = self.blockchain.get_latest_block()
-                    if index > latest_block.index:
+            for index, header_nodes in sorted(latest_blocks.items(), reverse=True):
+                for header, nodes in header_nodes.items():
+                    if index > self.blockchain.get_height() - 1:
                         self.synchronize_with(nodes[0])
                     else:
                         return
 
     def get_next_block(self):
-        new_block_index = self.blockchain.get_latest_block().index + 1
-        if not self.next_block or self.next_block.index != new_block_index:
-            if new_block_index in self.transaction_pool:
-                for tx in self.transaction_pool[new_block_index]:
-                    try:
-                        self.blockchain.add_transaction(tx)
-                    except BlockchainException as e:
-                        pass
-                del self.transaction_pool[new_block_index]
+        new_block_index = self.blockchain.get_height()
+        template = self.blockchain.template
+        if template is not None and template.index == new_block_index and \
+            template.fee_transaction.destination == self.miner_address:
+            self.next_block = template.get_block()
+        else:
+            self.mempool.expire(new_block_index)
+            for tx in self.mempool.transactions(new_block_index):
+                try:
+                    self.blockchain.add_transaction(tx)
+                except BlockchainException as e:
+                    self.mempool.remove(tx)
             self.next_block = self.blockchain.new_block(self.miner_address, self.get_time())
         return self.next_block
 
     async def mine_next_block(self):
         if self.miner is not None and not self.miner.closed:
             block = self.get_next_block()
+            if any(b.index != block.index for b in self.sent_blocks.values()):
+                self.sent_blocks = {}
+            self.sent_blocks[block.merkle_root] = block
             await self.miner.send_json({
                 'id': block.index,
                 'data': block.serialize(header_only = True).hex(),
@@ -427,11 +504,15 @@ class Node(LightNode):
         async for msg in self.miner:
             response = msg.json()
             header = Block.deserialize(bytes.fromhex(response['data']), header_only = True)
-            self.next_block.nonce = header.nonce
-            self.next_block.timestamp = header.timestamp
+            block = self.sent_blocks.get(header.merkle_root)
+            if block is None:
+                continue # Template of an older height
+            block.nonce = header.nonce
+            block.timestamp = header.timestamp
             try:
-                self.blockchain.is_valid_block(self.next_block)
-                self.block_queue.put(self.next_block)
+                self.blockchain.check_block_state(block)
+                await check_blocks_async([block])
+                self.block_queue.put(block)
             except BlockchainException as e:
                 print(e)
                 await self.mine_next_block()
@@ -0,0 +1,127 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from pydaten.core.blockcheck import check_blocks
+from pydaten.core.errors import BlockchainException
+from pydaten.defaults import config
+
+class Synchronizer:
+    # Catches up with a peer in rounds. The headers of a round are downloaded from the peer
+    # and their PoW and links are checked first. Then the blocks are downloaded in windows,
+    # from several peers at once, and connected in order. Only a few windows are kept ahead
+    # of the one being connected.
+
+    def __init__(self, node, peer):
+        self.node = node
+        self.blockchain = node.blockchain
+        self.peer = peer
+
+    def run(self):
+        # Returns the number of blocks connected.
+        connected = 0
+        start = self.blockchain.get_height()
+        headers = self.download_headers(start, start)
+        if headers and headers[0].previous_hash != self.blockchain.get_block_hash(start - 1):
+            # The peer is on another branch.
+            fork_height = self.node.find_fork_from(self.blockchain.get_locator(), self.peer)
+            if fork_height is None:
+                self.node.set_bad_peer(self.peer)
+                return connected
+            # Its branch has to be longer than ours to be taken.
+            headers = self.download_headers(fork_height + 1, start)
+            if headers:
+                headers = self.skip_shared(headers)
+        while headers:
+            if headers[0].previous_hash != self.blockchain.get_block_hash(headers[0].index - 1):
+                break # The peer has switched branch meanwhile
+            try:
+                count = self.connect(headers)
+            except BlockchainException:
+                self.node.set_bad_peer(self.peer)
+                return connected
+            connected += count
+            if count == 0:
+                break # Not longer than our branch
+            start = self.blockchain.get_height()
+            headers = self.download_headers(start, start)
+        return connected
+
+    def download_headers(self, start, end):
+        # A round of headers from 'start' and at least up to 'end', None when they are invalid.
+        end = max(start + config.SYNC_HEADERS, end + 1) - 1
+        headers = self.node.get_block_range_from(start, end, self.peer, header_only = True)
+        if not headers:
+            return headers
+        try:
+            check_blocks(headers)
+        except BlockchainException:
+            self.node.set_bad_peer(self.peer)
+            return None
+        for i, header in enumerate(headers):
+            if header.index != start + i or \
+                (i > 0 and header.previous_hash != headers[i - 1].calculate_hash()):
+                self.node.set_bad_peer(self.peer)
+                return None
+        return headers
+
+    def skip_shared(self, headers):
+        # The locator skips blocks, the ones we have are not downloaded again.
+        height = self.blockchain.get_height()
+        i = 0
+        while i < len(headers) - 1 and headers[i].index < height and \
+            headers[i].calculate_hash() == self.blockchain.get_block_hash(headers[i].index):
+            i += 1
+        return headers[i:]
+
+    def connect(self, headers):
+        connected = 0
+        branch = None
+        for blocks in self.download_blocks(headers):
+            if blocks is None:
+                self.node.set_bad_peer(self.peer)
+                break
+            if branch is None and blocks[0].index < self.blockchain.get_height():
+                # Our blocks are only replaced by a longer branch, taken as a whole. It is built
+                # on an overlay window after window, whatever its depth.
+                branch = self.blockchain.branch(blocks[0].index - 1)
+                start = blocks[0].index
+            if branch is not None:
+                for block in blocks:
+                    branch.push_block(block)
+                if branch.get_height() > self.blockchain.get_height():
+                    if not self.blockchain.merge(branch):
+                        break # Our blocks have changed meanwhile
+                    connected += branch.get_height() - start
+                    branch = None
+            else:
+                connected += self.blockchain.import_blocks(blocks)
+        return connected
+
+    def download_blocks(self, headers):
+        # The blocks of every window, in order. None for a window no peer has sent.
+        windows = [headers[i:i + config.SYNC_WINDOW] for i in range(0, len(headers), config.SYNC_WINDOW)]
+        peers = [self.peer] + [peer for peer in self.node.random_peers() if peer != self.peer]
+        pending = deque()
+        with ThreadPoolExecutor(max_workers = config.SYNC_DOWNLOADS) as executor:
+            try:
+                for number, window in enumerate(windows):
+                    pending.append(executor.submit(self.download_window, window, peers[number % len(peers)]))
+                    if len(pending) > config.SYNC_WINDOWS_AHEAD:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def download_window(self, window, peer):
+        # Blocks that do not match the checked headers are asked to the peer we sync with.
+        for source in dict.fromkeys([peer, self.peer]):
+            blocks = self.node.get_block_range_from(window[0].index, window[-1].index, source)
+            if blocks and len(blocks) == len(window) and \
+                all(b.serialize(header_only = True) == h.serialize(header_only = True) and b.valid()
+                    for b, h in zip(blocks, window)):
+                for block, header in zip(blocks, window):
+                    block.remember_hash(header.calculate_hash())
+                return blocks
+        return None
@@ -1,6 +1,7 @@
 import unittest
 import hashlib
 import time
+import struct
 from unittest.mock import *
 from pydaten.core.blockchain import Blockchain
 from pydaten.common.address import RawAddress, Address
@@ -10,6 +11,9 @@ from pydaten.common.data import NoData
 from pydaten.defaults import genesis, config
 from pydaten.core import difficulty
 from pydaten.crypto import ecdsa
+from pydaten.core.errors import *
+from pydaten.core.storage import MemoryStorage
+from pydaten.core.world import World
 from tempfile import mkdtemp
 from shutil import copytree
 
@@ -61,11 +65,48 @@ class BlockchainTest(unittest.TestCase):
                 self.assertEquals(bc3.get_height(), 5)
 
 
+    def test_fork_overlay(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                storage = MemoryStorage()
+                bc1 = Blockchain(storage)
+                bc2 = Blockchain(MemoryStorage())
+                self.put_block(bc1, 'shared')
+                bc2.import_blocks(bc1.get_blocks()[1:])
+                self.put_block(bc1, 'mine1', config.SUPPLY_NAME, BlockchainTest.BOB_ADDRESS, 100)
+                self.put_block(bc1, 'mine2')
+                self.put_block(bc2, 'theirs1', config.SUPPLY_NAME, BlockchainTest.CHARLIE_ADDRESS, 100)
+                self.put_block(bc2, 'theirs2')
+                self.assertEqual(bc1.resolve(Address.from_string('@mine1')), config.SUPPLY_NAME)
+                # Not longer, nothing is written.
+                before = dict(storage.values)
+                self.assertFalse(bc1.fork(bc2.get_blocks()[2:]))
+                self.assertEqual(storage.values, before)
+                self.put_block(bc2, 'theirs3')
+                self.assertTrue(bc1.fork(bc2.get_blocks()[2:]))
+                self.assertEqual(bc1.get_height(), 5)
+                self.assertEqual([bc1.get_block_hash(i) for i in range(5)], [bc2.get_block_hash(i) for i in range(5)])
+                self.assertIsNone(bc1.resolve(Address.from_string('@mine1')))
+                self.assertEqual(bc1.get_balance(BlockchainTest.BOB_ADDRESS), 0)
+                self.assertEqual(bc1.get_balance(BlockchainTest.CHARLIE_ADDRESS), 100)
+                self.assertEqual(bc1.get_block(3).transactions[0].name, 'theirs2')
+                reopened = World(storage)
+                self.assertEqual([reopened.get_block_hash(i) for i in range(5)], [bc2.get_block_hash(i) for i in range(5)])
+                # A branch read before our last block is not merged, even when longer.
+                self.put_block(bc2, 'theirs4')
+                self.put_block(bc2, 'theirs5')
+                branch = bc1.branch(4)
+                for block in bc2.get_blocks()[5:]:
+                    branch.push_block(block)
+                self.put_block(bc1, 'mine3')
+                self.assertFalse(bc1.merge(branch))
+                self.assertEqual(bc1.get_block(5).transactions[0].name, 'mine3')
+
     def test_push_pop_block(self):
         config.MINIMUM_BYTE_PRICE = 0
         with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
             with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
-                bc = Blockchain(mkdtemp())
+                bc = Blockchain(MemoryStorage())
                 self.put_block(bc, 'rnd1', config.SUPPLY_NAME, BlockchainTest.BOB_ADDRESS, 1000)
                 self.assertEquals(bc.get_balance(BlockchainTest.BOB_ADDRESS), 1000)
                 self.put_block(bc, 'rnd2', config.SUPPLY_NAME, BlockchainTest.BOB_ADDRESS, 500)
@@ -79,6 +120,307 @@ class BlockchainTest(unittest.TestCase):
                 bc.pop_block()
                 self.assertEquals(bc.get_balance(BlockchainTest.BOB_ADDRESS), 0)
 
+    def test_pop_block_undo(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc1 = Blockchain(mkdtemp())
+                bc2 = Blockchain(mkdtemp())
+                self.put_block(bc1, 'rnd1', config.SUPPLY_NAME, BlockchainTest.BOB_ADDRESS, 1000)
+                self.put_block(bc1, 'bob', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 100)
+                bc2.import_blocks(bc1.get_blocks()[1:])
+                bob = Address.from_string('@bob')
+                self.put_block(bc1, 'post1', bob, BlockchainTest.CHARLIE_ADDRESS, 200)
+                self.put_block(bc1, 'charlie', BlockchainTest.CHARLIE_ADDRESS, BlockchainTest.BOB_ADDRESS, 50)
+                self.put_block(bc1, 'post2', Address.from_string('@charlie'), bob, 0)
+                # Popped from the undo records, on an overlay with empty caches, no transaction is decoded.
+                with patch.object(Transaction, 'deserialize', side_effect = Transaction.deserialize) as mock_deserialize:
+                    self.assertEqual(bc1.branch(2).get_height(), 3)
+                    self.assertEqual(mock_deserialize.call_count, 0)
+                bc1.pop_block()
+                bc1.pop_block()
+                bc1.pop_block()
+                # Nothing is left of the popped blocks.
+                self.assertEqual(list(bc1.world.root.iterator()), list(bc2.world.root.iterator()))
+                self.assertEqual(bc1.get_balance(BlockchainTest.BOB_ADDRESS), 900)
+                self.assertEqual(bc1.get_balance(BlockchainTest.CHARLIE_ADDRESS), 100)
+                self.assertIsNone(bc1.resolve(Address.from_string('@charlie')))
+                self.assertEqual(bc1.find_children(bob), [])
+                self.assertEqual([tx.name for tx in bc1.latest(BlockchainTest.CHARLIE_ADDRESS)], ['bob'])
+                # Undo records are pruned with the bodies.
+                bc3 = Blockchain(MemoryStorage(), prune_depth = 2)
+                bc3.import_blocks(bc1.get_blocks()[1:])
+                for name in ['rnd2', 'rnd3']:
+                    self.put_block(bc3, name)
+                self.assertEqual(bc3.world.get_pruned_height(), 3)
+                bc3.pop_block()
+                bc3.pop_block()
+                with self.assertRaises(BlockPruned):
+                    bc3.pop_block()
+                self.assertEqual(bc3.get_height(), 3)
+
+    def test_migrate_layout_0(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                path = mkdtemp()
+                bc = Blockchain(path)
+                self.put_block(bc, 'rnd1', config.SUPPLY_NAME, BlockchainTest.BOB_ADDRESS, 1000)
+                self.put_block(bc, 'bob', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 100)
+                self.put_block(bc, 'post1', Address.from_string('@bob'), Address.from_string('@bob'), 0)
+                blocks = [b.serialize() for b in bc.get_blocks()]
+                # Layout 0 kept the transaction under its name entry and a pointer to it per block.
+                root = bc.world.root
+                for k, entry in list(root.iterator(prefix = World.TRANSACTION_PREFIX)):
+                    tag, index, position, offset, length = struct.unpack('>BLLLL', entry)
+                    root.put(k, root.get(World.BODY_PREFIX + struct.pack('>L', index))[offset:offset + length])
+                    root.put(World.BLOCK_TRANSACTION_PREFIX + struct.pack('>LL', index, position), k)
+                layout_0 = [World.HEIGHT_PREFIX, World.HEADER_PREFIX, World.TRANSACTION_PREFIX, World.BLOCK_TRANSACTION_PREFIX,
+                            World.SHORTCUT_PREFIX, World.RESOLVE_PREFIX, World.BALANCE_PREFIX]
+                for k in list(root.iterator(include_value = False)):
+                    if k[:1] not in layout_0:
+                        root.delete(k)
+                root.close()
+                world = World(path)
+                self.assertEqual(world.get_layout(), World.LAYOUT_VERSION)
+                self.assertEqual(list(world.root.iterator(prefix = World.BLOCK_TRANSACTION_PREFIX)), [])
+                self.assertEqual([world.get_block(i).serialize() for i in range(4)], blocks)
+                self.assertEqual(world.find(Address.from_string('@bob')).name, 'bob')
+                self.assertEqual([tx.name for tx in world.find_children(Address.from_string('@bob'))], ['post1'])
+                self.assertEqual([tx.name for tx in world.history(BlockchainTest.BOB_ADDRESS)], ['rnd1', 'bob', 'post1'])
+                self.assertEqual(world.get_balance(BlockchainTest.BOB_ADDRESS), 900)
+                # Popped like any block pushed after the migration.
+                world.pop_block()
+                self.assertEqual(world.find_children(Address.from_string('@bob')), [])
+
+    def test_import_blocks(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc1 = Blockchain(MemoryStorage())
+                bc2 = Blockchain(MemoryStorage())
+                self.put_block(bc1, 'rnd1', config.SUPPLY_NAME, BlockchainTest.BOB_ADDRESS, 1000)
+                self.put_block(bc1, 'bob', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 100)
+                self.put_block(bc1, 'rnd2', Address.from_string('@bob'), BlockchainTest.CHARLIE_ADDRESS, 200)
+                blocks = bc1.get_blocks()[1:]
+                self.assertEqual(bc2.import_blocks(blocks[:2], flush_blocks = 1), 2)
+                self.assertEqual(bc2.import_blocks(blocks[2:]), 1)
+                self.assertEqual(bc2.get_height(), 4)
+                self.assertEqual(bc2.get_balance(BlockchainTest.BOB_ADDRESS), 700)
+                self.assertEqual(bc2.get_balance(BlockchainTest.CHARLIE_ADDRESS), 300)
+                self.assertEqual(bc2.resolve(Address.from_string('@bob')), BlockchainTest.BOB_ADDRESS)
+                self.put_block(bc1, 'rnd3')
+                bc3 = Blockchain(MemoryStorage())
+                with self.assertRaises(InvalidIndex):
+                    bc3.import_blocks(blocks[:2] + bc1.get_blocks()[4:])
+                self.assertEqual(bc3.get_height(), 3)
+
+    def test_latest(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc = Blockchain(MemoryStorage())
+                self.put_block(bc, 'rnd1', config.SUPPLY_NAME, BlockchainTest.BOB_ADDRESS, 1000)
+                self.put_block(bc, 'rnd2', config.SUPPLY_NAME, BlockchainTest.CHARLIE_ADDRESS, 1000)
+                self.put_block(bc, 'rnd3', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 10)
+                self.assertEqual([tx.name for tx in bc.latest(BlockchainTest.BOB_ADDRESS)], ['rnd1', 'rnd3'])
+                self.assertEqual([tx.name for tx in bc.latest(BlockchainTest.BOB_ADDRESS, limit = 1)], ['rnd3'])
+                self.assertEqual([tx.name for tx in bc.latest(BlockchainTest.BOB_ADDRESS, before = 3)], ['rnd1'])
+                self.assertEqual(len(bc.latest(BlockchainTest.ALICE_ADDRESS)), 6)
+                bc.pop_block()
+                self.assertEqual([tx.name for tx in bc.latest(BlockchainTest.CHARLIE_ADDRESS)], ['rnd2'])
+
+    def test_find_children(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc = Blockchain(MemoryStorage())
+                self.put_block(bc, 'bob', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 0)
+                bob = Address.from_string('@bob')
+                for name in ['post1', 'post2', 'post3']:
+                    self.put_block(bc, name, BlockchainTest.BOB_ADDRESS, bob, 0)
+                self.assertEqual(bc.count_children(bob), 3)
+                self.assertEqual([tx.name for tx in bc.find_children(bob)], ['post1', 'post2', 'post3'])
+                self.assertEqual([tx.name for tx in bc.find_children(bob, after = 0, limit = 1)], ['post2'])
+                self.assertEqual([tx.name for tx in bc.find_children(bob, after = 1)], ['post3'])
+                bc.pop_block()
+                self.assertEqual(bc.count_children(bob), 2)
+                self.put_block(bc, 'post4', BlockchainTest.BOB_ADDRESS, bob, 0)
+                self.assertEqual([tx.name for tx in bc.find_children(bob, after = 1)], ['post4'])
+
+    def test_pruning(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc = Blockchain(MemoryStorage(), prune_depth = 2)
+                self.put_block(bc, 'bob', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 0)
+                for name in ['rnd1', 'rnd2', 'rnd3']:
+                    self.put_block(bc, name)
+                self.assertEqual(bc.world.get_pruned_height(), 3)
+                with self.assertRaises(BlockPruned):
+                    bc.get_block(1)
+                self.assertEqual(bc.get_header(1).index, 1)
+                self.assertEqual(bc.find(Address.from_string('@bob')).name, 'bob')
+                self.assertEqual(bc.resolve(Address.from_string('@bob')), BlockchainTest.BOB_ADDRESS)
+                self.assertEqual([tx.name for tx in bc.latest(BlockchainTest.CHARLIE_ADDRESS)], [])
+                self.assertEqual(bc.pop_block().index, 4)
+                bc.pop_block()
+                with self.assertRaises(BlockPruned):
+                    bc.pop_block()
+                with self.assertRaises(ForkTooDeep):
+                    bc.fork([bc.get_header(2)])
+
+    def test_header_index(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                storage = MemoryStorage()
+                bc = Blockchain(storage)
+                for name in ['rnd1', 'rnd2', 'rnd3']:
+                    self.put_block(bc, name)
+                bc.pop_block()
+                self.put_block(bc, 'rnd4')
+                reopened = World(storage)
+                for world in [bc.world, reopened]:
+                    self.assertEqual(world.get_height(), 4)
+                    headers = bc.get_header_range(0, 4)
+                    self.assertEqual(world.get_timestamps(0, 4), [h.timestamp for h in headers])
+                    self.assertEqual([world.get_block_hash(i) for i in range(4)], [h.calculate_hash() for h in headers])
+                    self.assertEqual(world.get_difficulty(3), headers[3].difficulty)
+
+    def test_block_hash(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                storage = MemoryStorage()
+                bc = Blockchain(storage)
+                for name in ['rnd1', 'rnd2']:
+                    self.put_block(bc, name)
+                hashes = [h.calculate_hash() for h in bc.get_header_range(0, 3)]
+                self.assertEqual(hashes[0], genesis.GENESIS_HASH)
+                with patch.object(config, 'POW_HASH_FUNCTION', side_effect = lambda header: hashlib.sha256(header).digest()) as mock_hash:
+                    view = bc.world.view()
+                    for world in [World(storage), view]:
+                        self.assertEqual([world.get_block_hash(i) for i in range(3)], hashes)
+                    view.close()
+                    self.assertEqual(mock_hash.call_count, 0)
+                    # Memoized until the header changes.
+                    block = Block.deserialize(bc.get_block(2).serialize())
+                    block.calculate_hash()
+                    block.calculate_hash()
+                    block.nonce += 1
+                    block.calculate_hash()
+                    self.assertEqual(mock_hash.call_count, 2)
+                # Stored by the migration to layout 4.
+                for i in range(3):
+                    storage.delete(World.BLOCK_HASH_PREFIX + struct.pack('>L', i))
+                storage.put(World.LAYOUT_PREFIX, struct.pack('>L', 3))
+                World(storage)
+                self.assertEqual([storage.get(World.BLOCK_HASH_PREFIX + struct.pack('>L', i)) for i in range(3)], hashes)
+
+    def test_block_by_hash(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                storage = MemoryStorage()
+                bc1 = Blockchain(storage)
+                bc2 = Blockchain(MemoryStorage())
+                for name in ['rnd{}'.format(i) for i in range(15)]:
+                    self.put_block(bc1, name)
+                bc2.import_blocks(bc1.get_blocks()[1:13])
+                top = bc1.get_block_hash(15)
+                self.assertEqual(bc1.get_block_by_hash(top).serialize(), bc1.get_block(15).serialize())
+                locator = bc1.get_locator()
+                self.assertEqual(locator[:10], [bc1.get_block_hash(i) for i in range(15, 5, -1)])
+                self.assertEqual(locator[10:], [bc1.get_block_hash(i) for i in [4, 0]])
+                self.assertEqual(bc2.find_fork(locator), 12)
+                self.assertEqual(bc2.find_fork(locator[:3]), None)
+                bc1.pop_block()
+                self.assertIsNone(bc1.get_block_by_hash(top))
+                # Indexed by the migration to layout 5.
+                for k in list(storage.iterator(prefix = World.HASH_PREFIX, include_value = False)):
+                    storage.delete(k)
+                storage.put(World.LAYOUT_PREFIX, struct.pack('>L', 4))
+                self.assertEqual(World(storage).get_height_by_hash(bc1.get_block_hash(14)), 14)
+
+    def test_signature_verification(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc = Blockchain(MemoryStorage())
+                for name in ['a', 'b', 'c', 'd', 'e']:
+                    bc.add_transaction(Transaction(
+                        version = config.VERSION, target = 1, fee = 0, name = name,
+                        source = config.SUPPLY_NAME, destination = BlockchainTest.BOB_ADDRESS,
+                        amount = 0, data = NoData(), signature = b'\0' * 71))
+                block = bc.new_block(BlockchainTest.ALICE_ADDRESS, BlockchainTest.TIMER)
+                BlockchainTest.TIMER += 1
+                # Verified when they were added to the pool
+                calls = mock_verify.call_count
+                bc.push_block(block)
+                self.assertEqual(mock_verify.call_count, calls)
+                bc.pop_block()
+                bc.signature_cache.clear()
+                bad = block.transactions[3].signable()
+                mock_verify.side_effect = lambda message, public_key, signature: message != bad
+                with patch.object(config, 'VERIFY_CHUNK_SIZE', 2), patch.object(config, 'VERIFY_WORKERS', 2):
+                    with self.assertRaises(InvalidTransactionSignature):
+                        bc.push_block(block)
+                    mock_verify.side_effect = None
+                    bc.push_block(block)
+                self.assertEqual(bc.get_height(), 2)
+
+    def test_add_transaction(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc = Blockchain(MemoryStorage())
+                self.put_block(bc, 'rnd1', config.SUPPLY_NAME, BlockchainTest.BOB_ADDRESS, 1000)
+                def transaction(name, source, destination, amount):
+                    return Transaction(
+                        version = config.VERSION, target = bc.get_height(), fee = 0, name = name,
+                        source = source, destination = destination,
+                        amount = amount, data = NoData(), signature = b'\0' * 71)
+                bc.add_transaction(transaction('a', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 600))
+                with self.assertRaises(DuplicatedTransactionsFound):
+                    bc.add_transaction(transaction('a', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 600))
+                with self.assertRaises(NameTaken):
+                    bc.add_transaction(transaction('a', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 1))
+                with self.assertRaises(BalanceNotEnough):
+                    bc.add_transaction(transaction('b', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 401))
+                bc.add_transaction(transaction('c', BlockchainTest.CHARLIE_ADDRESS, BlockchainTest.BOB_ADDRESS, 100))
+                bc.add_transaction(transaction('b', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 500))
+                bc.push_block(bc.new_block(BlockchainTest.ALICE_ADDRESS, BlockchainTest.TIMER))
+                BlockchainTest.TIMER += 1
+                self.assertEqual(bc.get_balance(BlockchainTest.BOB_ADDRESS), 0)
+                self.assertEqual(bc.spent, {})
+
+    def test_view(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc = Blockchain(MemoryStorage())
+                self.put_block(bc, 'bob', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 0)
+                bob = Address.from_string('@bob')
+                latest = bc.get_latest_block() # Cached before the view is taken
+                view = bc.view()
+                bc.pop_block()
+                self.put_block(bc, 'rnd1')
+                self.assertEqual(view.get_height(), 2)
+                self.assertEqual(view.get_latest_block().transactions[0].name, 'bob')
+                self.assertEqual(view.resolve(bob), BlockchainTest.BOB_ADDRESS)
+                self.assertIsNone(bc.resolve(bob))
+                self.assertNotEqual(bc.get_latest_block().transactions[0].name, 'bob')
+                with self.assertRaises(Exception):
+                    view.pop_block()
+                # No pool of transactions nor signature cache is built for a view.
+                self.assertFalse(hasattr(view, 'signature_cache'))
+                view.close()
+
+    def test_resolve_many(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                bc = Blockchain(MemoryStorage())
+                self.put_block(bc, 'bob', BlockchainTest.BOB_ADDRESS, BlockchainTest.CHARLIE_ADDRESS, 0)
+                bob = Address.from_string('@bob')
+                unknown = Address.from_string('@unknown')
+                self.assertEqual(bc.resolve(bob), BlockchainTest.BOB_ADDRESS)
+                resolved = bc.resolve_many([bob, unknown, BlockchainTest.ALICE_ADDRESS])
+                self.assertEqual(resolved[bob], BlockchainTest.BOB_ADDRESS)
+                self.assertIsNone(resolved[unknown])
+                self.assertEqual(resolved[BlockchainTest.ALICE_ADDRESS], BlockchainTest.ALICE_ADDRESS)
+                bc.pop_block()
+                self.assertIsNone(bc.resolve_many([bob])[bob])
+                self.assertIsNone(bc.resolve(bob))
+
 
 if __name__ == '__main__':
     unittest.main()
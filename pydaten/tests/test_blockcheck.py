@@ -0,0 +1,30 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+from pydaten.core import blockcheck
+from pydaten.core.errors import *
+from pydaten.common.block import Block
+from pydaten.defaults import genesis, config
+
+class BlockCheckTest(unittest.TestCase):
+
+    def test_check_blocks(self):
+        block = genesis.genesis_block()
+        header = Block.deserialize(block.serialize(header_only = True), header_only = True)
+        with patch.object(config, 'BLOCK_CHECK_CHUNK_SIZE', 1):
+            blockcheck.check_blocks([block, header])
+        with patch.object(config, 'POW_HASH_FUNCTION') as mock_hash:
+            # Computed by the workers
+            self.assertEqual(block.calculate_hash(), genesis.GENESIS_HASH)
+            self.assertEqual(header.calculate_hash(), genesis.GENESIS_HASH)
+            self.assertEqual(mock_hash.call_count, 0)
+        block.merkle_root = b'\0' * 32
+        with self.assertRaises(InvalidBlock):
+            asyncio.get_event_loop().run_until_complete(blockcheck.check_blocks_async([block]))
+        with patch.object(config, 'BLOCK_CHECK_MAX_PENDING', 0):
+            with self.assertRaises(VerificationBusy):
+                asyncio.get_event_loop().run_until_complete(blockcheck.check_blocks_async([header]))
+        self.assertEqual(blockcheck._pending, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+from pydaten.utils.lru import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_eviction_by_weight(self):
+        cache = LRUCache(10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.size, 8)
+        cache.put('d', 4, 11)
+        self.assertNotIn('d', cache)
+
+    def test_counters(self):
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.pop('a')
+        cache.get('a')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['entries'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
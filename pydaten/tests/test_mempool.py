@@ -0,0 +1,38 @@
+import unittest
+from pydaten.core.mempool import Mempool
+from pydaten.common.address import RawAddress
+from pydaten.common.transaction import Transaction
+from pydaten.common.data import NoData
+from pydaten.defaults import config
+
+class MempoolTest(unittest.TestCase):
+
+    def transaction(self, name, fee, target = 1):
+        return Transaction(
+            version = config.VERSION, target = target, fee = fee, name = name,
+            source = RawAddress(b'A' * 33), destination = RawAddress(b'B' * 33),
+            amount = 0, data = NoData(), signature = b'\0' * 71)
+
+    def test_mempool(self):
+        size = len(self.transaction('a', 0).serialize())
+        pool = Mempool(max_bytes = 3 * size, target_window = 2)
+        self.assertTrue(pool.add(self.transaction('a', 100), 1))
+        self.assertFalse(pool.add(self.transaction('a', 100), 1))
+        self.assertTrue(pool.add(self.transaction('b', 300), 1))
+        self.assertTrue(pool.add(self.transaction('c', 200, 2), 1))
+        self.assertFalse(pool.add(self.transaction('d', 300, 0), 1)) # Behind the tip
+        self.assertFalse(pool.add(self.transaction('e', 300, 4), 1)) # Too far ahead
+        # Full, only a better paying transaction gets in.
+        self.assertFalse(pool.add(self.transaction('f', 50), 1))
+        self.assertTrue(pool.add(self.transaction('g', 400), 1))
+        self.assertEqual([tx.name for tx in pool.transactions(1)], ['g', 'b'])
+        self.assertEqual(pool.size, 3 * size)
+        pool.expire(2)
+        self.assertEqual([tx.name for tx in pool.transactions(2)], ['c'])
+        stats = pool.stats()
+        self.assertEqual((stats['transactions'], stats['evicted'], stats['expired']), (1, 1, 2))
+        self.assertEqual(stats['targets'], {2: 1})
+        self.assertEqual(stats['feeRates']['count'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
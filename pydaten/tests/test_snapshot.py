@@ -0,0 +1,106 @@
+import unittest
+import io
+from unittest.mock import *
+from pydaten.core.blockchain import Blockchain
+from pydaten.core.world import World
+from pydaten.core.storage import MemoryStorage
+from pydaten.core import snapshot, difficulty
+from pydaten.core.errors import SnapshotCorrupted, SnapshotHeightUnavailable
+from pydaten.common.address import Address
+from pydaten.defaults import config
+from pydaten.crypto import ecdsa
+from pydaten.tests import test_blockchain
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_export_import(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                helper = test_blockchain.BlockchainTest()
+                bc = Blockchain(MemoryStorage())
+                helper.put_block(bc, 'rnd1', config.SUPPLY_NAME, test_blockchain.BlockchainTest.BOB_ADDRESS, 1000)
+                helper.put_block(bc, 'bob', test_blockchain.BlockchainTest.BOB_ADDRESS, test_blockchain.BlockchainTest.CHARLIE_ADDRESS, 100)
+                helper.put_block(bc, 'rnd2', config.SUPPLY_NAME, test_blockchain.BlockchainTest.BOB_ADDRESS, 500)
+                helper.put_block(bc, 'carl', test_blockchain.BlockchainTest.CHARLIE_ADDRESS, test_blockchain.BlockchainTest.BOB_ADDRESS, 50)
+                blocks = bc.get_blocks()
+
+                stream = io.BytesIO()
+                digest = snapshot.export_snapshot(bc.world, stream, 3)
+                storage = MemoryStorage()
+                stream.seek(0)
+                self.assertEqual(snapshot.import_snapshot(World(storage), stream), digest)
+
+                replica = Blockchain(storage)
+                self.assertEqual(replica.get_height(), 3)
+                self.assertEqual(replica.get_balance(test_blockchain.BlockchainTest.BOB_ADDRESS), 900)
+                self.assertEqual(replica.get_balance(test_blockchain.BlockchainTest.CHARLIE_ADDRESS), 100)
+                self.assertEqual(replica.resolve(Address.from_string('@bob')), test_blockchain.BlockchainTest.BOB_ADDRESS)
+                self.assertIsNone(replica.resolve(Address.from_string('@rnd2')))
+                self.assertEqual(replica.find(Address.from_string('@bob')).amount, 100)
+                # The locator of a replica stops at the lowest header it has.
+                with patch.object(config, 'SNAPSHOT_HEADERS', 1):
+                    stream = io.BytesIO()
+                    snapshot.export_snapshot(bc.world, stream, 3)
+                    stream.seek(0)
+                    storage = MemoryStorage()
+                    snapshot.import_snapshot(World(storage), stream)
+                headers_only = Blockchain(storage)
+                self.assertEqual(headers_only.get_locator(), [bc.get_block_hash(2)])
+                self.assertEqual(bc.find_fork(headers_only.get_locator()), 2)
+                self.assertEqual(replica.get_locator(), [bc.get_block_hash(i) for i in [2, 1, 0]])
+                replica.import_blocks(blocks[3:])
+                self.assertEqual(replica.get_height(), 5)
+                self.assertEqual(replica.get_balance(test_blockchain.BlockchainTest.BOB_ADDRESS), 1450)
+
+    def test_pruned(self):
+        with patch.object(difficulty,  'less_or_equal', return_value = True) as mock_less_or_equal:
+            with patch.object(ecdsa,  'verify', return_value = True) as mock_verify:
+                helper = test_blockchain.BlockchainTest()
+                bc = Blockchain(MemoryStorage(), prune_depth = 2)
+                for name in ['rnd1', 'rnd2', 'rnd3']:
+                    helper.put_block(bc, name)
+                self.assertEqual(bc.world.get_pruned_height(), 2)
+                for height in [1, 2]:
+                    with self.assertRaises(SnapshotHeightUnavailable):
+                        snapshot.export_snapshot(bc.world, io.BytesIO(), height)
+                stream = io.BytesIO()
+                snapshot.export_snapshot(bc.world, stream, 3)
+                stream.seek(0)
+                snapshot.import_snapshot(World(MemoryStorage()), stream)
+
+    def test_corrupted(self):
+        bc = Blockchain(MemoryStorage())
+        stream = io.BytesIO()
+        snapshot.export_snapshot(bc.world, stream)
+        raw = bytearray(stream.getvalue())
+        raw[20] ^= 1
+        world = World(MemoryStorage())
+        with self.assertRaises(SnapshotCorrupted):
+            snapshot.import_snapshot(world, io.BytesIO(bytes(raw)))
+        self.assertEqual(world.get_height(), 0)
+        self.assertEqual(list(world.root.iterator(include_value = False)), [World.LAYOUT_PREFIX])
+
+    def test_interrupted(self):
+        bc = Blockchain(MemoryStorage())
+        stream = io.BytesIO()
+        snapshot.export_snapshot(bc.world, stream)
+        storage = MemoryStorage()
+        world = World(storage)
+        with patch.object(config, 'IMPORT_FLUSH_BYTES', 1):
+            with patch.object(World, '_store_hashes', side_effect = OSError()):
+                with self.assertRaises(OSError):
+                    snapshot.import_snapshot(world, io.BytesIO(stream.getvalue()))
+        # Batches were written, a crash would leave them with the marker.
+        self.assertIsNotNone(storage.get(World.IMPORTING_PREFIX))
+        World(storage)
+        self.assertEqual(list(storage.iterator(include_value = False)), [World.LAYOUT_PREFIX])
+        # Any error in the middle of the import clears what was written.
+        world = World(storage)
+        with patch.object(config, 'IMPORT_FLUSH_BYTES', 1):
+            with patch.object(snapshot._HashingReader, 'read_uint32', side_effect = [snapshot.VERSION, 1, OSError()]):
+                with self.assertRaises(OSError):
+                    snapshot.import_snapshot(world, io.BytesIO(stream.getvalue()))
+        self.assertEqual(list(storage.iterator(include_value = False)), [World.LAYOUT_PREFIX])
+
+if __name__ == '__main__':
+    unittest.main()
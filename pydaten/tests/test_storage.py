@@ -0,0 +1,110 @@
+import unittest
+from pydaten.core.storage import LevelDBStorage, MemoryStorage, CompressedStorage, InstrumentedStorage, OverlayStorage
+from tempfile import mkdtemp
+
+class StorageTest(unittest.TestCase):
+
+    def check(self, storage):
+        storage.put(b'\x01b', b'2')
+        storage.put(b'\x01a', b'1')
+        storage.put(b'\x02a', b'3')
+        storage.put(b'\x01\xff', b'4')
+        with storage.write_batch() as wb:
+            wb.put(b'\x01c', b'5')
+            wb.delete(b'\x01b')
+        self.assertEqual(storage.get(b'\x01c'), b'5')
+        self.assertIsNone(storage.get(b'\x01b'))
+        self.assertEqual(list(storage.iterator(prefix = b'\x01', include_value = False)), [b'\x01a', b'\x01c', b'\x01\xff'])
+        self.assertEqual(list(storage.iterator(prefix = b'\x01', reverse = True, include_key = False)), [b'4', b'5', b'1'])
+        self.assertEqual(list(storage.iterator(start = b'\x01b', stop = b'\x02a')), [(b'\x01c', b'5'), (b'\x01\xff', b'4')])
+        it = storage.iterator(prefix = b'\x01')
+        it.seek(b'\x01b')
+        self.assertEqual(next(it), (b'\x01c', b'5'))
+        it.close()
+        snapshot = storage.snapshot()
+        storage.delete(b'\x01a')
+        self.assertIsNone(storage.get(b'\x01a'))
+        self.assertEqual(snapshot.get(b'\x01a'), b'1')
+        self.assertEqual(len(list(snapshot.iterator(prefix = b'\x01'))), 3)
+        snapshot.close()
+        storage.close()
+
+    def test_leveldb(self):
+        self.check(LevelDBStorage(mkdtemp()))
+
+    def test_memory(self):
+        self.check(MemoryStorage())
+        storage = MemoryStorage()
+        storage.put(b'\x01a', b'1')
+        it = storage.iterator(prefix = b'\x01')
+        storage.put(b'\x01b', b'2')
+        storage.delete(b'\x01a')
+        self.assertEqual(list(it), [(b'\x01a', b'1')])
+        # Nothing is copied once no iterator or snapshot reads the keys.
+        del it
+        keys = storage.keys
+        list(storage.iterator(prefix = b'\x01'))
+        storage.put(b'\x01c', b'3')
+        self.assertIs(storage.keys, keys)
+
+    def test_compressed(self):
+        self.check(CompressedStorage(LevelDBStorage(mkdtemp()), 'zlib', [b'\x01']))
+        inner = MemoryStorage()
+        inner.put(b'\x01old', b'x' * 100) # Written before compression was enabled
+        storage = CompressedStorage(inner, 'zlib', [b'\x01'])
+        with storage.write_batch() as wb:
+            wb.put(b'\x01new', b'y' * 100)
+            wb.put(b'\x02new', b'z' * 100)
+        self.assertLess(len(inner.get(b'\x01new')), 100)
+        self.assertEqual(inner.get(b'\x02new'), b'z' * 100)
+        self.assertEqual(list(storage.iterator(prefix = b'\x01', include_key = False)), [b'y' * 100, b'x' * 100])
+        lzma_storage = CompressedStorage(inner, 'lzma', [b'\x01'])
+        lzma_storage.put(b'\x01lzma', b'w' * 1000)
+        # Compressed values are read whatever codec, if any, is used for writing.
+        plain = CompressedStorage(inner, None, [b'\x01'])
+        self.assertEqual(plain.get(b'\x01new'), b'y' * 100)
+        self.assertEqual(plain.snapshot().get(b'\x01lzma'), b'w' * 1000)
+        plain.put(b'\x01plain', b'v' * 100)
+        self.assertEqual(inner.get(b'\x01plain'), b'v' * 100)
+
+    def test_overlay(self):
+        self.check(OverlayStorage(LevelDBStorage(mkdtemp())))
+        base = MemoryStorage()
+        for k in [b'\x01a', b'\x01c', b'\x01e']:
+            base.put(k, b'base')
+        storage = OverlayStorage(base)
+        with storage.write_batch() as wb:
+            wb.put(b'\x01b', b'new')
+            wb.put(b'\x01c', b'new')
+            wb.delete(b'\x01e')
+        self.assertEqual(list(storage.iterator(prefix = b'\x01')), [(b'\x01a', b'base'), (b'\x01b', b'new'), (b'\x01c', b'new')])
+        self.assertEqual(list(storage.iterator(prefix = b'\x01', reverse = True, include_value = False)), [b'\x01c', b'\x01b', b'\x01a'])
+        it = storage.iterator(prefix = b'\x01')
+        it.seek(b'\x01b')
+        self.assertEqual(next(it), (b'\x01b', b'new'))
+        self.assertIsNone(storage.get(b'\x01e'))
+        # Nothing reaches the storage below.
+        self.assertEqual(list(base.iterator(include_key = False)), [b'base'] * 3)
+
+    def test_instrumented(self):
+        self.check(InstrumentedStorage(MemoryStorage()))
+        storage = InstrumentedStorage(MemoryStorage(), {b'\x01': 'one'})
+        with storage.write_batch() as wb:
+            wb.put(b'\x01a', b'123')
+            wb.put(b'\x02a', b'4')
+            wb.delete(b'\x01b')
+        storage.get(b'\x01a')
+        storage.get(b'\x01c')
+        snapshot = storage.snapshot()
+        self.assertEqual(list(snapshot.iterator(prefix = b'\x02', include_key = False)), [b'4'])
+        stats = storage.stats()
+        self.assertEqual(stats['keyspaces']['one'], {'gets': 2, 'get_bytes': 5, 'misses': 1, 'puts': 1,
+                                                     'put_bytes': 5, 'deletes': 1, 'reads': 0, 'read_bytes': 0})
+        self.assertEqual(stats['keyspaces']['02']['reads'], 1)
+        self.assertEqual(stats['batches']['operations']['total'], 3)
+        self.assertEqual(stats['latency']['get']['count'], 2)
+        storage.reset()
+        self.assertEqual(storage.stats()['keyspaces'], {})
+
+if __name__ == '__main__':
+    unittest.main()
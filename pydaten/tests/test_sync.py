@@ -0,0 +1,99 @@
+import unittest
+from unittest.mock import patch
+from pydaten.core.blockchain import Blockchain
+from pydaten.core.storage import MemoryStorage
+from pydaten.core import difficulty
+from pydaten.crypto import ecdsa
+from pydaten.common.address import RawAddress
+from pydaten.common.block import Block
+from pydaten.common.transaction import Transaction
+from pydaten.common.data import NoData
+from pydaten.network.sync import Synchronizer
+from pydaten.defaults import config
+from pydaten.utils import misc
+
+class FakeNode:
+    # Peers are blockchains, see LightNode.
+
+    def __init__(self, blockchain, peers):
+        self.blockchain = blockchain
+        self.peers = peers
+        self.bad_peers = set()
+        self.requests = []
+
+    def random_peers(self):
+        return list(self.peers)
+
+    def set_bad_peer(self, peer):
+        self.bad_peers.add(peer)
+
+    def get_block_range_from(self, start, end, peer, header_only = False):
+        self.requests.append((peer, start, end, header_only))
+        remote = self.peers[peer]
+        end = min(end + 1, remote.get_height())
+        blocks = remote.get_header_range(start, end) if header_only else remote.get_block_range(start, end)
+        # Sent over the network.
+        return [Block.deserialize(b.serialize(header_only = header_only), header_only = header_only) for b in blocks]
+
+    def find_fork_from(self, locator, peer):
+        return self.peers[peer].find_fork(locator)
+
+class SynchronizerTest(unittest.TestCase):
+
+    TIMER = 0
+
+    def put_blocks(self, blockchain, count, destination = RawAddress(b'B' * 33)):
+        for i in range(count):
+            blockchain.add_transaction(Transaction(
+                version = config.VERSION, target = blockchain.get_height(), fee = 0, name = misc.random_name(),
+                source = config.SUPPLY_NAME, destination = destination,
+                amount = 0, data = NoData(), signature = b'\0' * 71))
+            blockchain.push_block(blockchain.new_block(RawAddress(b'A' * 33), SynchronizerTest.TIMER))
+            SynchronizerTest.TIMER += 1
+
+    def test_synchronize(self):
+        with patch.object(difficulty, 'less_or_equal', return_value = True), \
+             patch.object(ecdsa, 'verify', return_value = True), \
+             patch('pydaten.network.sync.check_blocks', side_effect = lambda blocks: [Blockchain.check_block(b) for b in blocks]), \
+             patch.object(config, 'SYNC_HEADERS', 4), patch.object(config, 'SYNC_WINDOW', 2), \
+             patch.object(config, 'SYNC_WINDOWS_AHEAD', 1):
+            remote = Blockchain(MemoryStorage())
+            self.put_blocks(remote, 3)
+            local = Blockchain(MemoryStorage())
+            local.import_blocks(remote.get_blocks()[1:])
+            self.put_blocks(local, 2, RawAddress(b'C' * 33))
+            self.put_blocks(remote, 6)
+            other = Blockchain(MemoryStorage())
+            other.import_blocks(remote.get_blocks()[1:])
+            node = FakeNode(local, {'remote': remote, 'other': other})
+            self.assertEqual(Synchronizer(node, 'remote').run(), 6)
+            self.assertEqual(local.get_height(), remote.get_height())
+            self.assertEqual(local.get_block_hash(9), remote.get_block_hash(9))
+            self.assertEqual(node.bad_peers, set())
+            # Bodies come from both peers, headers only from the one we sync with.
+            self.assertIn(('other', 6, 7, False), node.requests)
+            self.assertTrue(all(peer == 'remote' for peer, start, end, header_only in node.requests if header_only))
+            self.assertEqual(Synchronizer(node, 'remote').run(), 0)
+
+    def test_deep_fork(self):
+        with patch.object(difficulty, 'less_or_equal', return_value = True), \
+             patch.object(ecdsa, 'verify', return_value = True), \
+             patch('pydaten.network.sync.check_blocks', side_effect = lambda blocks: [Blockchain.check_block(b) for b in blocks]), \
+             patch.object(config, 'SYNC_HEADERS', 4), patch.object(config, 'SYNC_WINDOW', 2), \
+             patch.object(config, 'SYNC_WINDOWS_AHEAD', 1):
+            remote = Blockchain(MemoryStorage())
+            self.put_blocks(remote, 3)
+            local = Blockchain(MemoryStorage())
+            local.import_blocks(remote.get_blocks()[1:])
+            self.put_blocks(local, 4, RawAddress(b'C' * 33))
+            self.put_blocks(remote, 6)
+            node = FakeNode(local, {'remote': remote})
+            # The branch replacing ours spans several windows, it is pushed to an overlay as they come.
+            self.assertEqual(Synchronizer(node, 'remote').run(), 6)
+            self.assertEqual(local.get_height(), 10)
+            self.assertEqual(local.get_block_hash(9), remote.get_block_hash(9))
+            self.assertEqual(local.get_balance(RawAddress(b'C' * 33)), 0)
+            self.assertEqual(node.bad_peers, set())
+
+if __name__ == '__main__':
+    unittest.main()
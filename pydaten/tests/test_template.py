@@ -0,0 +1,35 @@
+import unittest
+from unittest.mock import patch
+from pydaten.core.template import BlockTemplate
+from pydaten.common.address import RawAddress
+from pydaten.common.transaction import Transaction
+from pydaten.common.data import NoData
+from pydaten.defaults import config
+
+class BlockTemplateTest(unittest.TestCase):
+
+    def transaction(self, name, fee):
+        return Transaction(
+            version = config.VERSION, target = 1, fee = fee, name = name,
+            source = RawAddress(b'A' * 33), destination = RawAddress(b'B' * 33),
+            amount = 0, data = NoData(), signature = b'\0' * 71)
+
+    def test_template(self):
+        template = BlockTemplate(1, 0, b'\0' * 32, config.MINIMUM_HASH_DIFFICULTY_COMPRESSED, RawAddress(b'C' * 33), 10)
+        size = 4 + len(self.transaction('a', 0).serialize())
+        with patch.object(config, 'MAX_BLOCK_SIZE', template.size + 2 * size):
+            template.add_all([self.transaction('a', 1), self.transaction('b', 3), self.transaction('c', 2)])
+            block = template.get_block()
+            self.assertEqual([tx.name for tx in block.transactions[:-2]], ['b', 'c'])
+            self.assertEqual(block.transactions[-2].amount, 5)
+            self.assertEqual(len(block.serialize()), template.size)
+            self.assertFalse(template.add(self.transaction('d', 9)))
+            self.assertIs(template.get_block(), block)
+        self.assertTrue(template.add(self.transaction('d', 9)))
+        updated = template.get_block()
+        self.assertEqual(updated.transactions[-2].amount, 14)
+        self.assertEqual(block.transactions[-2].amount, 5) # Still valid for the miner
+        self.assertEqual(updated.merkle_root, updated.calculate_merkle_root())
+
+if __name__ == '__main__':
+    unittest.main()
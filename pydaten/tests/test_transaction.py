@@ -0,0 +1,38 @@
+import unittest
+from pydaten.common.address import RawAddress
+from pydaten.common.transaction import Transaction
+from pydaten.common.data import NoData, BooleanData
+
+class TransactionTest(unittest.TestCase):
+
+    def test_memoized_encoding(self):
+        tx = Transaction(0, 1, 2, 'name', RawAddress(b'A' * 33), RawAddress(b'B' * 33), 5, NoData(), b'signature')
+        serialized = tx.serialize()
+        decoded = Transaction.deserialize(serialized)
+        self.assertEqual(decoded.serialize(), serialized)
+        self.assertEqual(decoded.calculate_hash(), tx.calculate_hash())
+        decoded.fee = 3
+        self.assertNotEqual(decoded.serialize(), serialized)
+        self.assertEqual(Transaction.deserialize(decoded.serialize()).fee, 3)
+        signable = decoded.signable()
+        decoded.signature = b'other'
+        self.assertEqual(decoded.signable(), signable)
+        self.assertEqual(Transaction.deserialize(decoded.serialize()).signature, b'other')
+
+    def test_non_canonical_encoding(self):
+        tx = Transaction(0, 1, 2, 'name', RawAddress(b'A' * 33), RawAddress(b'B' * 33), 5, BooleanData(False), b'signature')
+        serialized = tx.serialize()
+        # A boolean byte of 2 reads as False.
+        position = len(tx.signable()) - 1
+        odd = serialized[:position] + b'\x02' + serialized[position + 1:]
+        decoded = Transaction.deserialize(odd)
+        self.assertEqual(decoded.serialize(), serialized)
+        self.assertEqual(decoded.calculate_hash(), tx.calculate_hash())
+        # A truncated signature is the shorter signature.
+        decoded = Transaction.deserialize(serialized[:-3])
+        self.assertEqual(decoded.signature, b'signat')
+        self.assertEqual(decoded.serialize(), tx.signable() + b'\x06signat')
+        self.assertEqual(decoded.calculate_hash(), Transaction.deserialize(decoded.serialize()).calculate_hash())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+class Histogram:
+    # Counts of values in power of two buckets, bucket n holds values below 2 ** n.
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        bucket = int(value).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def json(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'buckets': {2 ** bucket: count for bucket, count in sorted(self.buckets.items())}}
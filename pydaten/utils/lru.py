@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, weight = 1):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if weight > self.capacity:
+                return # Would evict everything else.
+            self._entries[key] = (value, weight)
+            self.size += weight
+            while self.size > self.capacity:
+                self.size -= self._entries.popitem(last = False)[1][1]
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self.size, 'capacity': self.capacity,
+                'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,50 @@
+import threading
+from contextlib import contextmanager
+
+class RWLock:
+    # Many readers or one writer. The writer may take the lock again, or read, while holding it.
+    # Waiting writers keep new readers out so a steady flow of reads cannot starve them.
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me:
+                while self._writer is not None or self._waiting:
+                    self._condition.wait()
+                self._readers += 1
+        try:
+            yield
+        finally:
+            if self._writer != me:
+                with self._condition:
+                    self._readers -= 1
+                    if self._readers == 0:
+                        self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me:
+                self._waiting += 1
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+                self._waiting -= 1
+                self._writer = me
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._writer = None
+                    self._condition.notify_all()
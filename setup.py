@@ -17,4 +17,4 @@ setup(name = 'pydaten',
                 'pydaten.utils',
                 'pydaten.crypto'],
     package_data = {'': ['resources/*', 'resources/static/*']},
-    scripts = ['scripts/daten'])
+    scripts = ['scripts/daten', 'scripts/daten-admin'])